@@ -1,16 +1,2824 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
+import argparse
+import sys
 import threading
 import time
-import cv2
-import mss
-import numpy as np
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+import importlib
 import os
+import shutil
 import subprocess
-from datetime import datetime, timedelta
+import tempfile
+from collections import deque
+from datetime import datetime
 import json
+import csv
+import wave
+
+# Момент начала импорта модуля - точка отсчета для отчета о времени запуска
+STARTUP_TIME = time.perf_counter()
+
+
+class LazyModule:
+    # Тяжелые модули (cv2, numpy, mss) импортируются при первом обращении, а не при запуске:
+    # окно появляется сразу, а импорт идет в фоне (warm_up) или при первой записи
+    def __init__(self, name):
+        self.__dict__["name"] = name
+        self.__dict__["module"] = None
+
+    def load(self):
+        if self.module is None:
+            self.__dict__["module"] = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+mss = LazyModule("mss")
+
+
+def optional_import(name):
+    # Необязательные модули: sounddevice (звук с устройства) и lz4.block (сжатие спула);
+    # без них соответствующие режимы откатываются или сообщают, что нужно установить
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def warm_up(on_done=None):
+    # Фоновый импорт тяжелых модулей и первый экземпляр mss, пока пользователь смотрит на окно.
+    # on_done(мониторы) вызывается из фонового потока
+    def run():
+        monitors = []
+        try:
+            np.load()
+            cv2.load()
+            with mss.mss() as sct:
+                monitors = sct.monitors
+        except Exception as e:
+            print(f"Ошибка фоновой инициализации: {e}")
+        if on_done:
+            on_done(monitors)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+# Политики поведения очереди кадров, когда кодировщик не успевает за захватом
+QUEUE_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+# Форматы записи: встроенный cv2.VideoWriter или внешний ffmpeg, которому кадры передаются через stdin.
+# Если ffmpeg не найден, используется формат из "fallback".
+VIDEO_FORMATS = {
+    ".wmv": {"backend": "opencv", "fourcc": "WMV2", "extension": ".wmv"},
+    ".mp4": {"backend": "opencv", "fourcc": "mp4v", "extension": ".mp4"},
+    "x264 .mp4": {"backend": "ffmpeg", "codec": "libx264", "extension": ".mp4", "fallback": ".mp4"},
+    "x265 .mp4": {"backend": "ffmpeg", "codec": "libx265", "extension": ".mp4", "fallback": ".mp4"},
+    "vp9 .webm": {"backend": "ffmpeg", "codec": "libvpx-vp9", "extension": ".webm", "fallback": ".mp4"},
+}
+FFMPEG_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium")
+# Кодеки ffmpeg для форматов OpenCV: режим VFR пишет только через ffmpeg
+FFMPEG_CODECS = {".wmv": "wmv2", ".mp4": "mpeg4"}
+
+# Аудиокодек при сведении звука с видео, по расширению файла
+AUDIO_CODECS = {".mp4": "aac", ".wmv": "wmav2", ".webm": "libopus"}
+
+
+def ebml_uint(value):
+    return value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+
+
+def ebml_element(element_id, data):
+    # Элемент EBML (Matroska): идентификатор, длина 8-байтовым varint и данные
+    return element_id + b"\x01" + len(data).to_bytes(7, "big") + data
+
+
+class FFmpegEncoder:
+    # Кодировщик с интерфейсом cv2.VideoWriter (isOpened/write/release),
+    # передающий сырые BGR-кадры процессу ffmpeg через stdin.
+    # Кадры идут в простейшем потоке Matroska (V_UNCOMPRESSED, BGR24) с явным временем каждого кадра,
+    # поэтому повтор кадра (extend_last) только сдвигает время следующего: пиксели заново
+    # не передаются, а постоянную частоту кадров восстанавливает фильтр fps внутри ffmpeg.
+    # vfr=True - переменная частота кадров: фильтр fps не ставится, и в файл попадают только
+    # присланные кадры с их временем; повторы, отмеченные детектором, так и остаются сдвигом времени
+    def __init__(self, filename, codec, fps, size, preset="ultrafast", crf=23, threads=0, ffmpeg_path="ffmpeg", fragmented=False,
+                 vfr=False):
+        width, height = size
+        self.fps = fps
+        self.position = 0
+        self.last_frame = None
+        self.sent_position = -1
+        command = [ffmpeg_path] + FFMPEG_COMMON_ARGS + ["-f", "matroska", "-i", "-", "-c:v", codec]
+        if codec == "libvpx-vp9":
+            # У libvpx нет пресетов x264: ближайший аналог ultrafast - режим realtime с максимальным cpu-used
+            cpu_used = 8 - min(FFMPEG_PRESETS.index(preset) if preset in FFMPEG_PRESETS else 0, 5)
+            command += ["-deadline", "realtime", "-cpu-used", str(cpu_used), "-row-mt", "1", "-b:v", "0", "-crf", str(crf)]
+        elif codec in ("libx264", "libx265"):
+            command += ["-preset", preset, "-crf", str(crf)]
+        else:
+            command += ["-q:v", "3"]
+        if vfr:
+            command += ["-vsync", "vfr"]
+        else:
+            command += ["-vf", f"fps={fps}"]
+        if fragmented and filename.endswith(".mp4"):
+            # Фрагментированный MP4 остается проигрываемым, даже если процесс не дописал файл
+            command += ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+        command += ["-threads", str(threads), "-pix_fmt", "yuv420p", filename]
+
+        # Сообщения ffmpeg копятся во временном файле (канал без чтения мог бы заблокировать ffmpeg)
+        # и попадают в error, если ffmpeg завершился с ошибкой
+        self.stderr = tempfile.TemporaryFile()
+        self.error = None
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self.stderr, creationflags=FFMPEG_CREATIONFLAGS)
+        except OSError as e:
+            print(f"Не удалось запустить ffmpeg: {e}")
+            self.process = None
+            self.error = str(e)
+        self.failed = False
+        if self.process:
+            self.send(self.stream_header(width, height))
+
+    def stream_header(self, width, height):
+        # Время в Matroska - в микросекундах (TimecodeScale 1000 нс); DefaultDuration - один кадр
+        ebml = ebml_element(b"\x1a\x45\xdf\xa3",
+                            ebml_element(b"\x42\x86", ebml_uint(1)) + ebml_element(b"\x42\xf7", ebml_uint(1))
+                            + ebml_element(b"\x42\xf2", ebml_uint(4)) + ebml_element(b"\x42\xf3", ebml_uint(8))
+                            + ebml_element(b"\x42\x82", b"matroska") + ebml_element(b"\x42\x87", ebml_uint(4))
+                            + ebml_element(b"\x42\x85", ebml_uint(2)))
+        # Сегмент неизвестной длины: поток пишется в канал, вернуться и дописать размер нельзя
+        segment = b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff"
+        info = ebml_element(b"\x15\x49\xa9\x66", ebml_element(b"\x2a\xd7\xb1", ebml_uint(1000))
+                            + ebml_element(b"\x4d\x80", b"bandicam") + ebml_element(b"\x57\x41", b"bandicam"))
+        video = ebml_element(b"\xe0", ebml_element(b"\xb0", ebml_uint(width)) + ebml_element(b"\xba", ebml_uint(height))
+                             + ebml_element(b"\x2e\xb5\x24", b"BGR\x18"))
+        track = ebml_element(b"\xae", ebml_element(b"\xd7", ebml_uint(1)) + ebml_element(b"\x73\xc5", ebml_uint(1))
+                             + ebml_element(b"\x83", ebml_uint(1)) + ebml_element(b"\x9c", ebml_uint(0))
+                             + ebml_element(b"\x23\xe3\x83", ebml_uint(round(1e9 / self.fps)))
+                             + ebml_element(b"\x86", b"V_UNCOMPRESSED") + video)
+        return ebml + segment + info + ebml_element(b"\x16\x54\xae\x6b", track)
+
+    def send(self, *chunks):
+        # Запись блокируется, пока ffmpeg не освободит канал: это давление приходится на поток
+        # кодирования и кольцо кадров, а не на поток захвата
+        if self.failed:
+            return
+        try:
+            for chunk in chunks:
+                self.process.stdin.write(chunk)
+        except OSError as e:
+            self.failed = True
+            print(f"ffmpeg прервал кодирование: {e}")
+
+    def send_frame(self, frame, position):
+        # Кластер из одного кадра: время кластера и SimpleBlock (дорожка 1, смещение 0, ключевой кадр)
+        timecode = ebml_element(b"\xe7", ebml_uint(round(position * 1000000 / self.fps)))
+        block_size = 4 + frame.nbytes
+        block = b"\xa3\x01" + block_size.to_bytes(7, "big") + b"\x81\x00\x00\x80"
+        cluster_size = len(timecode) + len(block) + frame.nbytes
+        self.send(b"\x1f\x43\xb6\x75\x01" + cluster_size.to_bytes(7, "big") + timecode + block, frame.data)
+        self.sent_position = position
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame):
+        self.send_frame(frame, self.position)
+        self.position += 1
+        # Копия нужна только для завершения: последний кадр повторяется в конце, если его продлевали
+        if self.last_frame is None or self.last_frame.shape != frame.shape:
+            self.last_frame = np.empty_like(frame)
+        np.copyto(self.last_frame, frame)
+
+    def extend_last(self, count):
+        # Повтор последнего кадра: ни конвертации, ни передачи пикселей
+        if self.last_frame is not None:
+            self.position += count
+
+    def release(self):
+        if self.process is None:
+            return
+        # Последний кадр еще раз в конце продления, чтобы длительность файла не потерялась
+        if self.last_frame is not None and self.position - 1 > self.sent_position:
+            self.send_frame(self.last_frame, self.position - 1)
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        returncode = self.process.wait()
+        self.process = None
+        if returncode != 0:
+            self.stderr.seek(0)
+            lines = self.stderr.read().decode("utf-8", errors="replace").strip().splitlines()
+            self.error = f"ffmpeg завершился с кодом {returncode}" + (f": {lines[-1]}" if lines else "")
+        self.stderr.close()
+
+
+def write_repeated(writer, frame, count):
+    # Кадр count раз подряд; writer с extend_last (FFmpegEncoder) продлевает его без повторного кодирования,
+    # cv2.VideoWriter (форматы без ffmpeg) сжимает каждый повтор заново - экономится только конвертация
+    if count <= 0:
+        return
+    writer.write(frame)
+    if count > 1 and hasattr(writer, "extend_last"):
+        writer.extend_last(count - 1)
+    else:
+        for _ in range(count - 1):
+            writer.write(frame)
+
+
+def find_ffmpeg(ffmpeg_path="ffmpeg"):
+    return shutil.which(ffmpeg_path)
+
+
+# Общие параметры всех запусков ffmpeg; в собранном --noconsole exe не показываем окно консоли ffmpeg
+FFMPEG_COMMON_ARGS = ["-hide_banner", "-loglevel", "error", "-y"]
+FFMPEG_CREATIONFLAGS = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+
+
+def run_ffmpeg(ffmpeg, args):
+    # ffmpeg - путь из find_ffmpeg; возвращает subprocess.CompletedProcess
+    return subprocess.run([ffmpeg] + FFMPEG_COMMON_ARGS + args, creationflags=FFMPEG_CREATIONFLAGS)
+
+
+def effective_video_format(video_format, ffmpeg_path="ffmpeg"):
+    # Формат, которым запись пойдет на самом деле: ffmpeg-формат без ffmpeg заменяется на свой fallback
+    if video_format not in VIDEO_FORMATS:
+        return ".wmv"
+    spec = VIDEO_FORMATS[video_format]
+    if spec["backend"] == "ffmpeg" and not find_ffmpeg(ffmpeg_path):
+        return spec["fallback"]
+    return video_format
+
+
+def create_video_writer(base_filename, video_format, fps, size, preset="ultrafast", crf=23, threads=0, ffmpeg_path="ffmpeg", fragmented=False):
+    # Возвращает (writer, имя файла). Для ffmpeg-форматов без установленного ffmpeg
+    # откатывается на cv2.VideoWriter
+    spec = VIDEO_FORMATS.get(video_format, VIDEO_FORMATS[".wmv"])
+    if spec["backend"] == "ffmpeg":
+        ffmpeg = find_ffmpeg(ffmpeg_path)
+        if ffmpeg:
+            filename = base_filename + spec["extension"]
+            return FFmpegEncoder(filename, spec["codec"], fps, size, preset, crf, threads, ffmpeg, fragmented), filename
+        print(f"ffmpeg не найден, формат {video_format} заменен на {spec['fallback']}")
+        spec = VIDEO_FORMATS[spec["fallback"]]
+
+    filename = base_filename + spec["extension"]
+    fourcc = cv2.VideoWriter_fourcc(*spec["fourcc"])
+    return cv2.VideoWriter(filename, fourcc, fps, size), filename
+
+
+def create_vfr_writer(base_filename, video_format, fps, size, preset="ultrafast", crf=23, threads=0, ffmpeg_path="ffmpeg", fragmented=False):
+    # Writer режима VFR: кадры идут в ffmpeg по мере записи, при остановке ничего не перекодируется.
+    # Без ffmpeg запись идет обычным writer с постоянной частотой кадров
+    ffmpeg = find_ffmpeg(ffmpeg_path)
+    if not ffmpeg:
+        print("ffmpeg не найден, VFR-запись идет с постоянной частотой кадров")
+        return create_video_writer(base_filename, video_format, fps, size, preset, crf, threads, ffmpeg_path, fragmented)
+    spec = VIDEO_FORMATS.get(video_format, VIDEO_FORMATS[".wmv"])
+    codec = spec.get("codec") or FFMPEG_CODECS.get(spec["extension"], "mpeg4")
+    filename = base_filename + spec["extension"]
+    return FFmpegEncoder(filename, codec, fps, size, preset, crf, threads, ffmpeg, fragmented, vfr=True), filename
+
+
+def bgra_view(sct_img):
+    # Представление сырого буфера mss (BGRA) как массива без копирования
+    return np.frombuffer(sct_img.raw, dtype=np.uint8).reshape(sct_img.height, sct_img.width, 4)
+
+
+def fit_frame(src, dst):
+    # Копирует кадр в предвыделенный буфер: обрезает лишний пиксель выравнивания,
+    # а масштабирует только если захват неожиданно меньше нужного размера
+    height, width = dst.shape[:2]
+    if src.shape[0] >= height and src.shape[1] >= width:
+        np.copyto(dst, src[:height, :width])
+    else:
+        cv2.resize(src, (width, height), dst=dst)
+
+
+class MssSource:
+    # Источник кадров - экран через mss. open() вызывается в потоке захвата:
+    # в Windows объект mss нельзя передавать между потоками
+    def __init__(self):
+        self.sct = None
+
+    def open(self):
+        self.sct = mss.mss()
+
+    def close(self):
+        if self.sct:
+            self.sct.close()
+            self.sct = None
+
+    def monitors(self):
+        return self.sct.monitors
+
+    def full_region(self):
+        return dict(self.sct.monitors[1])
+
+    def grab(self, region):
+        return bgra_view(self.sct.grab(region))
+
+
+class SyntheticSource:
+    # Детерминированный источник для тестов и замеров без экрана: диагональные полосы,
+    # сдвигающиеся с частотой change_rate (доля захватов, на которых картинка меняется).
+    # monitor_count делит картинку на несколько "мониторов" одинаковой ширины, стоящих рядом.
+    PERIOD = 256
+
+    def __init__(self, width=1920, height=1080, change_rate=1.0, step=4, monitor_count=1):
+        self.width = width
+        self.monitor_count = monitor_count
+        self.height = height
+        self.change_rate = change_rate
+        self.step = step
+        self.offset = 0
+        self.phase = 0.0
+        self.pattern = None
+
+    def open(self):
+        if self.pattern is None:
+            x = np.arange(self.width + self.PERIOD, dtype=np.uint16)
+            y = np.arange(self.height, dtype=np.uint16)[:, None]
+            self.pattern = np.empty((self.height, self.width + self.PERIOD, 4), dtype=np.uint8)
+            self.pattern[..., 0] = (x + y) % 256
+            self.pattern[..., 1] = (x * 3 // 2) % 256
+            self.pattern[..., 2] = (y * 2) % 256
+            self.pattern[..., 3] = 255
+
+    def close(self):
+        pass
+
+    def monitors(self):
+        width = self.width // self.monitor_count
+        return [self.full_region()] + [{"left": index * width, "top": 0, "width": width, "height": self.height}
+                                       for index in range(self.monitor_count)]
+
+    def full_region(self):
+        return {"left": 0, "top": 0, "width": self.width, "height": self.height}
+
+    def grab(self, region):
+        left, top = region["left"], region["top"]
+        width, height = region["width"], region["height"]
+        if left < 0 or top < 0 or left + width > self.width or top + height > self.height:
+            raise ValueError(f"Область {width}x{height}+{left}+{top} выходит за пределы {self.width}x{self.height}")
+        self.phase += self.change_rate
+        if self.phase >= 1:
+            self.phase -= 1
+            self.offset = (self.offset + self.step) % self.PERIOD
+        # Без копирования: смещенное окно в заранее построенном узоре
+        return self.pattern[top:top + height, left + self.offset:left + self.offset + width]
+
+    def cursor_position(self):
+        # Курсор ходит по кругу и "кликает" левой кнопкой раз в PERIOD шагов
+        angle = self.offset / self.PERIOD * 2 * np.pi
+        x = int(self.width / 2 + np.cos(angle) * self.width / 4)
+        y = int(self.height / 2 + np.sin(angle) * self.height / 4)
+        return x, y, 1 if self.offset < self.step * 4 else 0
+
+
+class ReplaySource:
+    # Источник кадров из видеофайла (по кругу), кадр подгоняется под размер области
+    def __init__(self, filename, loop=True):
+        self.filename = filename
+        self.loop = loop
+        self.capture = None
+        self.frame = None
+        self.bgra = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.filename)
+        if not self.capture.isOpened():
+            raise ValueError(f"Не удалось открыть файл для воспроизведения: {self.filename}")
+
+    def close(self):
+        if self.capture:
+            self.capture.release()
+            self.capture = None
+
+    def full_region(self):
+        width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        return {"left": 0, "top": 0, "width": width, "height": height}
+
+    def monitors(self):
+        region = self.full_region()
+        return [region, region]
+
+    def grab(self, region):
+        ok, self.frame = self.capture.read(self.frame)
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, self.frame = self.capture.read(self.frame)
+        if not ok:
+            raise ValueError(f"Файл закончился: {self.filename}")
+        if self.bgra is None or self.bgra.shape[:2] != self.frame.shape[:2]:
+            self.bgra = np.empty(self.frame.shape[:2] + (4,), dtype=np.uint8)
+        cv2.cvtColor(self.frame, cv2.COLOR_BGR2BGRA, dst=self.bgra)
+        left, top = region["left"], region["top"]
+        return self.bgra[top:top + region["height"], left:left + region["width"]]
+
+
+def create_source(name="screen", region=None, change_rate=1.0, monitor_count=1):
+    # "screen" - экран, "synthetic" - генератор, иначе путь к видеофайлу для воспроизведения.
+    # region - область или список областей: генератор строится так, чтобы вместить их все
+    if name == "screen":
+        return MssSource()
+    if name == "synthetic":
+        regions = [item for item in (region if isinstance(region, list) else [region]) if isinstance(item, dict)]
+        if regions:
+            return SyntheticSource(max(item["left"] + item["width"] for item in regions),
+                                   max(item["top"] + item["height"] for item in regions), change_rate,
+                                   monitor_count=monitor_count)
+        return SyntheticSource(1920 * monitor_count, change_rate=change_rate, monitor_count=monitor_count)
+    return ReplaySource(name)
+
+
+class SoundDeviceAudio:
+    # Микрофон или системный звук (loopback, только WASAPI в Windows) через sounddevice.
+    # Колбэк PortAudio лишь отдает блок дальше вместе с монотонным временем его первого сэмпла
+    def __init__(self, loopback=False, samplerate=48000, channels=2):
+        self.sounddevice = optional_import("sounddevice")
+        if self.sounddevice is None:
+            raise RuntimeError("Для записи звука с устройства установите пакет sounddevice")
+        self.loopback = loopback
+        self.samplerate = samplerate
+        self.channels = channels
+        self.stream = None
+
+    def start(self, callback):
+        device = None
+        extra_settings = None
+        if self.loopback:
+            try:
+                extra_settings = self.sounddevice.WasapiSettings(loopback=True)
+            except (AttributeError, TypeError):
+                raise RuntimeError("Запись системного звука (loopback) не поддерживается этой версией sounddevice")
+            device = self.sounddevice.default.device[1]
+
+        def on_audio(block, frames, time_info, status):
+            callback(block.copy(), time.monotonic() - frames / self.samplerate)
+
+        self.stream = self.sounddevice.InputStream(samplerate=self.samplerate, channels=self.channels, dtype="int16",
+                                              device=device, extra_settings=extra_settings, callback=on_audio)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+class TimedAudioSource:
+    # Основа программных источников звука: свой поток отдает блоки по block_seconds
+    # в реальном времени, как это делала бы звуковая карта
+    def __init__(self, samplerate=48000, channels=2, block_seconds=0.02):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.block_seconds = block_seconds
+        self.running = False
+        self.thread = None
+
+    def start(self, callback):
+        self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(callback,), daemon=True)
+        self.thread.start()
+
+    def run(self, callback):
+        started = time.monotonic()
+        produced = 0
+        while self.running:
+            due = int((time.monotonic() - started) * self.samplerate)
+            if due > produced:
+                callback(self.read(due - produced), started + produced / self.samplerate)
+                produced = due
+            time.sleep(self.block_seconds)
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.close()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SyntheticAudio(TimedAudioSource):
+    # Синусоида для тестов и замеров без звуковой карты
+    def __init__(self, samplerate=48000, channels=2, frequency=440):
+        super().__init__(samplerate, channels)
+        self.frequency = frequency
+        self.position = 0
+
+    def read(self, frames):
+        t = (np.arange(self.position, self.position + frames) / self.samplerate)[:, None]
+        self.position += frames
+        tone = (np.sin(2 * np.pi * self.frequency * t) * 8000).astype(np.int16)
+        return np.repeat(tone, self.channels, axis=1)
+
+
+class WavFileAudio(TimedAudioSource):
+    # Воспроизведение 16-битного WAV-файла (по кругу) как источника звука
+    def __init__(self, filename, loop=True):
+        with wave.open(filename, "rb") as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError(f"Поддерживаются только 16-битные WAV-файлы: {filename}")
+            super().__init__(wav.getframerate(), wav.getnchannels())
+        self.filename = filename
+        self.loop = loop
+        self.wav = None
+
+    def open(self):
+        self.wav = wave.open(self.filename, "rb")
+
+    def close(self):
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+    def read(self, frames):
+        data = self.wav.readframes(frames)
+        if len(data) < frames * self.channels * 2 and self.loop:
+            self.wav.rewind()
+            data += self.wav.readframes(frames - len(data) // (self.channels * 2))
+        block = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+        if len(block) < frames:
+            block = np.concatenate([block, np.zeros((frames - len(block), self.channels), dtype=np.int16)])
+        return block
+
+
+def create_audio_source(name, samplerate=48000, channels=2):
+    # "" - без звука; "microphone", "loopback" (системный звук), "synthetic" или путь к WAV-файлу
+    if not name:
+        return None
+    if name == "microphone":
+        return SoundDeviceAudio(False, samplerate, channels)
+    if name == "loopback":
+        return SoundDeviceAudio(True, samplerate, channels)
+    if name == "synthetic":
+        return SyntheticAudio(samplerate, channels)
+    return WavFileAudio(name)
+
+
+class AudioRecorder:
+    # Звуковая дорожка записи. Источник только добавляет блоки в deque (append/popleft
+    # потокобезопасны без блокировок), поток записи переводит монотонное время блока
+    # во время видео через timeline (None - блок пришелся на паузу) и пишет WAV,
+    # заполняя разрывы тишиной и обрезая наложения, чтобы звук не уплывал от видео
+    TOLERANCE_SECONDS = 0.02
+
+    def __init__(self, source, filename, timeline):
+        self.source = source
+        self.filename = filename
+        self.timeline = timeline
+        self.blocks = deque()
+        self.running = False
+        self.thread = None
+        self.wav = None
+        self.written = 0
+
+    def start(self):
+        self.wav = wave.open(self.filename, "wb")
+        self.wav.setnchannels(self.source.channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(self.source.samplerate)
+        self.running = True
+        self.thread = threading.Thread(target=self.write_blocks)
+        self.thread.start()
+        self.source.start(self.add_block)
+
+    def add_block(self, block, timestamp):
+        self.blocks.append((timestamp, block))
+
+    def write_blocks(self):
+        samplerate = self.source.samplerate
+        tolerance = int(self.TOLERANCE_SECONDS * samplerate)
+        while self.running or self.blocks:
+            if not self.blocks:
+                time.sleep(0.01)
+                continue
+            timestamp, block = self.blocks.popleft()
+            position = self.timeline(timestamp)
+            if position is None:
+                continue
+            gap = int(position * samplerate) - self.written
+            if gap > tolerance:
+                self.write(np.zeros((gap, block.shape[1]), dtype=np.int16))
+            elif gap < -tolerance:
+                block = block[-gap:]
+            self.write(block)
+
+    def write(self, block):
+        self.wav.writeframes(np.ascontiguousarray(block, dtype=np.int16).tobytes())
+        self.written += len(block)
+
+    def stop(self):
+        self.source.stop()
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+
+# Форматы скриншотов: "raw" - несжатый BMP без потерь
+SCREENSHOT_FORMATS = {"jpg": ".jpg", "png": ".png", "webp": ".webp", "raw": ".bmp"}
+
+
+def encode_image(image, image_format="jpg", quality=95, png_compression=3):
+    if image_format == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif image_format == "jpg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    else:
+        params = []
+    return cv2.imencode(SCREENSHOT_FORMATS.get(image_format, ".jpg"), image, params)
+
+
+class ScreenshotWorker:
+    # Фоновые потоки для скриншотов: захват и кодирование не занимают главный поток Tk.
+    # Захват идет в своем потоке сразу после запроса и не ждет кодирования прошлых снимков,
+    # поэтому снимки серии следуют с шагом burst_interval_ms; кодирование и запись - по порядку
+    # в отдельном потоке.
+    def __init__(self):
+        self.captures = queue.Queue()
+        self.jobs = queue.Queue()
+        self.capture_thread = None
+        self.thread = None
+        self.source = None
+
+    def submit(self, job):
+        # job: output_folder, taken (datetime), image_format, quality, png_compression,
+        # region или monitor (номер монитора, 0 - все мониторы одной картинкой, "each" - каждый монитор
+        # отдельным снимком; без них - первый монитор) или frame (готовый BGRA-кадр), on_done(filename), on_error(error)
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        if job.get("frame") is not None:
+            self.jobs.put(job)
+            return
+        if self.capture_thread is None or not self.capture_thread.is_alive():
+            self.capture_thread = threading.Thread(target=self.capture, daemon=True)
+            self.capture_thread.start()
+        self.captures.put(job)
+
+    def capture(self):
+        # mss открывается в потоке захвата: в Windows объект mss нельзя передавать между потоками
+        while True:
+            job = self.captures.get()
+            if job is None:
+                break
+            try:
+                if self.source is None:
+                    self.source = MssSource()
+                    self.source.open()
+                for region in self.job_regions(job):
+                    frame = self.source.grab(region)
+                    # Время снимка - момент захвата пикселей
+                    self.jobs.put(dict(job, frame=frame, taken=datetime.now()))
+            except Exception as e:
+                if job.get("on_error"):
+                    job["on_error"](e)
+        if self.source:
+            self.source.close()
+            self.source = None
+
+    def job_regions(self, job):
+        if job.get("region"):
+            return [job["region"]]
+        monitors = self.source.monitors()
+        selected = job.get("monitor", 1)
+        if selected == "each":
+            return [dict(monitor) for monitor in monitors[1:]]
+        return [dict(monitors[selected if isinstance(selected, int) and selected < len(monitors) else 1])]
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                filename = self.save(job)
+                if job.get("on_done"):
+                    job["on_done"](filename)
+            except Exception as e:
+                if job.get("on_error"):
+                    job["on_error"](e)
+
+    def save(self, job):
+        image = cv2.cvtColor(job["frame"], cv2.COLOR_BGRA2BGR)
+
+        is_success, buffer = encode_image(image, job.get("image_format", "jpg"), job.get("quality", 95), job.get("png_compression", 3))
+        if not is_success:
+            raise Exception("Не удалось закодировать изображение для сохранения.")
+
+        output_folder = job["output_folder"]
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+        extension = SCREENSHOT_FORMATS.get(job.get("image_format"), ".jpg")
+        base_filename = os.path.join(output_folder, f"screenshot_{job['taken'].strftime('%Y-%m-%d_%H-%M-%S')}")
+        filename = base_filename + extension
+        # Несколько снимков за секунду (серия) не должны перезаписывать друг друга
+        number = 1
+        while os.path.exists(filename):
+            filename = f"{base_filename}_{number}{extension}"
+            number += 1
+        with open(filename, "wb") as f:
+            f.write(buffer)
+        return filename
+
+    def stop(self):
+        if self.capture_thread and self.capture_thread.is_alive():
+            self.captures.put(None)
+            self.capture_thread.join(timeout=5)
+        if self.thread and self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join(timeout=5)
+
+
+# Имена констант cv2: сам cv2 импортируется лениво
+INTERPOLATIONS = {"nearest": "INTER_NEAREST", "linear": "INTER_LINEAR",
+                  "area": "INTER_AREA", "cubic": "INTER_CUBIC"}
+
+
+def output_size(width, height, scale=1.0, output_width=0, output_height=0):
+    # Размер выходного видео: явная ширина/высота (вторая по пропорции) или масштаб; всегда четный
+    if output_width and output_height:
+        width, height = output_width, output_height
+    elif output_width:
+        width, height = output_width, round(height * output_width / width)
+    elif output_height:
+        width, height = round(width * output_height / height), output_height
+    else:
+        width, height = round(width * scale), round(height * scale)
+    return max(2, width - width % 2), max(2, height - height % 2)
+
+
+class FrameScaler:
+    # Масштабирование кадра в предвыделенный буфер. В режиме "auto" уменьшение идет через
+    # INTER_AREA: для ровно 2x у OpenCV есть быстрый путь, который обгоняет cv2.pyrDown
+    def __init__(self, source_size, target_size, interpolation="auto"):
+        self.target_size = tuple(target_size)
+        self.identity = tuple(source_size) == self.target_size
+        self.buffer = None if self.identity else np.empty((target_size[1], target_size[0], 4), dtype=np.uint8)
+        downscale = target_size[0] < source_size[0]
+        self.interpolation = getattr(cv2, INTERPOLATIONS.get(interpolation, "INTER_AREA" if downscale else "INTER_LINEAR"))
+
+    def scale(self, frame):
+        if self.identity:
+            return frame
+        cv2.resize(frame, self.target_size, dst=self.buffer, interpolation=self.interpolation)
+        return self.buffer
+
+
+class Sprite:
+    # Заранее подготовленная картинка для наложения: 256 - альфа и цвет, умноженный на альфу
+    # (альфа в диапазоне 0..256, чтобы смешивание укладывалось в uint16 и делилось сдвигом)
+    def __init__(self, bgra, hotspot=(0, 0)):
+        alpha = (bgra[..., 3:4].astype(np.uint16) * 256 + 127) // 255
+        self.inverse = 256 - alpha
+        self.premultiplied = bgra[..., :3].astype(np.uint16) * alpha
+        self.hotspot = hotspot
+
+
+def blend_sprite(frame, sprite, x, y):
+    # Смешивание на месте только в прямоугольнике спрайта, обрезанном по границам кадра
+    x -= sprite.hotspot[0]
+    y -= sprite.hotspot[1]
+    height, width = sprite.inverse.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, frame.shape[1]), min(y + height, frame.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    sprite_rows = slice(y0 - y, y1 - y)
+    sprite_cols = slice(x0 - x, x1 - x)
+    roi = frame[y0:y1, x0:x1, :3]
+    blended = roi * sprite.inverse[sprite_rows, sprite_cols] + sprite.premultiplied[sprite_rows, sprite_cols]
+    np.right_shift(blended, 8, out=blended)
+    roi[...] = blended
+
+
+def draw_antialiased(size, draw, supersample=4):
+    # Рисует спрайт в увеличенном виде и уменьшает его - получаются сглаженные края
+    canvas = np.zeros((size[1] * supersample, size[0] * supersample, 4), dtype=np.uint8)
+    draw(canvas, supersample)
+    return cv2.resize(canvas, size, interpolation=cv2.INTER_AREA)
+
+
+def make_arrow_sprite(scale=1.0):
+    points = np.array([(0, 0), (0, 17), (4, 13), (7, 20), (10, 19), (7, 12), (12, 12)], dtype=np.float64)
+
+    def draw(canvas, supersample):
+        outline = np.round((points * scale + 1) * supersample).astype(np.int32)
+        cv2.fillPoly(canvas, [outline], (255, 255, 255, 255))
+        cv2.polylines(canvas, [outline], True, (0, 0, 0, 255), max(1, int(1.5 * scale * supersample)))
+
+    size = (int(14 * scale) + 3, int(22 * scale) + 3)
+    return Sprite(draw_antialiased(size, draw), (1, 1))
+
+
+def make_ripple_sprites(color, steps=8, scale=1.0):
+    # Расходящееся кольцо вокруг клика: steps кадров анимации с растущим радиусом и затуханием
+    radius = int(22 * scale)
+    size = 2 * radius + 5
+    sprites = []
+    for step in range(steps):
+        progress = (step + 1) / steps
+        opacity = int(220 * (1 - progress) + 30)
+
+        def draw(canvas, supersample, progress=progress, opacity=opacity):
+            center = (size * supersample // 2, size * supersample // 2)
+            cv2.circle(canvas, center, int((4 + (radius - 4) * progress) * supersample),
+                       (*color, opacity), max(1, int(3 * scale * supersample)))
+
+        sprites.append(Sprite(draw_antialiased((size, size), draw), (size // 2, size // 2)))
+    return sprites
+
+
+def windows_cursor_provider():
+    # Положение курсора и нажатые кнопки мыши (1 - левая, 2 - правая) через WinAPI
+    import ctypes
+    from ctypes import wintypes
+    user32 = ctypes.windll.user32
+    point = wintypes.POINT()
+
+    def provider():
+        if not user32.GetCursorPos(ctypes.byref(point)):
+            return None
+        buttons = (1 if user32.GetAsyncKeyState(0x01) & 0x8000 else 0) | (2 if user32.GetAsyncKeyState(0x02) & 0x8000 else 0)
+        return point.x, point.y, buttons
+
+    return provider
+
+
+def create_cursor_provider(source):
+    # Источник сам может знать курсор (синтетический), иначе спрашиваем систему
+    provider = getattr(source, "cursor_position", None)
+    if provider:
+        return provider
+    if os.name == 'nt':
+        return windows_cursor_provider()
+    return None
+
+
+class CursorOverlay:
+    # Курсор и подсветка кликов поверх кадра. Спрайты готовятся один раз, смешивание идет
+    # целочисленно и только в прямоугольнике спрайта - микросекунды на кадр.
+    # provider() возвращает (x, y, нажатые кнопки) в координатах экрана или None
+    RIPPLE_SECONDS = 0.4
+    RIPPLE_STEPS = 8
+    RIPPLE_COLORS = {1: (0, 215, 255), 2: (255, 140, 0)}
+
+    def __init__(self, provider, scale=1.0, highlight_clicks=True):
+        self.provider = provider
+        self.highlight_clicks = highlight_clicks
+        self.arrow = make_arrow_sprite(scale)
+        self.ripple_sprites = {button: make_ripple_sprites(color, self.RIPPLE_STEPS, scale)
+                               for button, color in self.RIPPLE_COLORS.items()}
+        self.ripples = []
+        self.buttons = 0
+        self.position = None
+        self.state = None
+
+    def sample(self):
+        # Вызывается один раз на захват. Возвращает состояние, по которому видно,
+        # изменилась ли картинка курсора с прошлого кадра
+        self.position = self.provider()
+        now = time.monotonic()
+        if self.position is None:
+            self.ripples = []
+            return None
+        x, y, buttons = self.position
+        if self.highlight_clicks:
+            for button in self.RIPPLE_COLORS:
+                if buttons & button and not self.buttons & button:
+                    self.ripples.append((x, y, button, now))
+        self.buttons = buttons
+        ripples = []
+        for ripple_x, ripple_y, button, started in self.ripples:
+            step = int((now - started) / self.RIPPLE_SECONDS * self.RIPPLE_STEPS)
+            if step < self.RIPPLE_STEPS:
+                ripples.append((ripple_x, ripple_y, button, step))
+        self.ripples = [ripple for ripple in self.ripples if now - ripple[3] < self.RIPPLE_SECONDS]
+        self.state = (x, y, tuple(ripples))
+        return self.state
+
+    def draw(self, frame, left, top):
+        # frame - BGRA-кадр области, left/top - положение области на экране
+        if self.position is None:
+            return
+        x, y, ripples = self.state
+        for ripple_x, ripple_y, button, step in ripples:
+            blend_sprite(frame, self.ripple_sprites[button][step], ripple_x - left, ripple_y - top)
+        blend_sprite(frame, self.arrow, x - left, y - top)
+
+
+class FrameRing:
+    # Ограниченное кольцо предвыделенных буферов между потоком захвата и потоком кодирования.
+    # Захват берет свободный буфер (acquire), заполняет его и публикует (publish);
+    # кодировщик забирает готовый буфер вместе с числом повторов (get) и возвращает его в кольцо (release).
+    # Индекс None означает повтор предыдущего кадра без новых данных (duplicate).
+    def __init__(self, shape, depth=8, policy="drop-oldest", buffer=None):
+        if policy not in QUEUE_POLICIES:
+            policy = "drop-oldest"
+        self.policy = policy
+        depth = max(1, depth)
+        if buffer is None:
+            self.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(depth)]
+        else:
+            # Буферы поверх общей памяти, чтобы их могли читать процессы-кодировщики
+            self.buffers = list(np.ndarray((depth,) + tuple(shape), dtype=np.uint8, buffer=buffer))
+        self.free = deque(range(len(self.buffers)))
+        self.ready = deque()
+        self.carry = 0
+        self.closed = False
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while not self.free:
+                if self.closed:
+                    return None
+                if self.policy == "drop-newest":
+                    self.dropped += 1
+                    return None
+                if self.policy == "drop-oldest" and self.ready:
+                    # Повторы вытесненного кадра переходят к следующему, чтобы длительность не терялась
+                    index, repeat = self.ready.popleft()
+                    self.carry += repeat
+                    if index is None:
+                        continue
+                    self.dropped += 1
+                    return index
+                self.cond.wait(0.1)
+            return self.free.popleft()
+
+    def publish(self, index, repeat=1):
+        with self.cond:
+            self.ready.append([index, repeat + self.carry])
+            self.carry = 0
+            self.cond.notify_all()
+
+    def duplicate(self, repeat):
+        # Экран не изменился: продлеваем последний кадр, не занимая буфер
+        with self.cond:
+            if self.ready:
+                self.ready[-1][1] += repeat
+            else:
+                self.ready.append([None, repeat])
+                self.cond.notify_all()
+
+    def defer(self, repeat):
+        # Кадр не попал в кольцо: его длительность достанется следующему опубликованному кадру
+        with self.cond:
+            self.carry += repeat
+
+    def get(self, timeout=0.1):
+        with self.cond:
+            if not self.ready and not self.closed:
+                self.cond.wait(timeout)
+            if not self.ready:
+                return None
+            return tuple(self.ready.popleft())
+
+    def release(self, index):
+        with self.cond:
+            self.free.append(index)
+            self.cond.notify_all()
+
+    def depth(self):
+        with self.cond:
+            return len(self.ready)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ChangeDetector:
+    # Определяет, изменился ли экран с прошлого кадра, по сигнатуре кадра: суммам пикселей
+    # по строкам и по столбцам (cv2.reduce - один проход по памяти на сумму, без копии кадра).
+    # Сдвиг содержимого по вертикали меняет суммы строк, по горизонтали - суммы столбцов.
+    # Суммы столбцов нужны, только когда суммы строк совпали; после кадра, где они не считались,
+    # следующий кадр с теми же строками один раз считается измененным.
+    # Если измененный кадр не попал в очередь, invalidate() заставляет считать следующий кадр
+    # измененным - иначе в файле остался бы устаревший кадр, пока экран не сменится снова.
+    def __init__(self, tile_size=64, report_tiles=False):
+        self.tile_size = tile_size
+        self.report_tiles = report_tiles
+        self.rows = self.columns = None
+        self.previous_rows = self.previous_columns = None
+        self.columns_valid = False
+        self.forced = False
+        self.changed_tiles = []
+        self.changed_tiles_total = 0
+        self.skipped_frames = 0
+
+    def invalidate(self):
+        self.forced = True
+
+    def reduce(self, frame, dim, dst):
+        cv2.reduce(frame.reshape(frame.shape[0], -1), dim, cv2.REDUCE_SUM, dst=dst, dtype=cv2.CV_32S)
+
+    def is_changed(self, frame):
+        height, width = frame.shape[:2]
+        row_values = frame.shape[1] * (frame.shape[2] if frame.ndim == 3 else 1)
+        if self.rows is None or self.rows.shape[0] != height or self.columns.shape[1] != row_values:
+            self.rows, self.previous_rows = np.empty((height, 1), np.int32), np.empty((height, 1), np.int32)
+            self.columns, self.previous_columns = np.empty((1, row_values), np.int32), np.empty((1, row_values), np.int32)
+            self.reduce(frame, 1, self.previous_rows)
+            self.columns_valid = False
+            self.forced = False
+            self.set_changed_tiles([(0, 0, width, height)])
+            return True
+
+        self.reduce(frame, 1, self.rows)
+        if np.array_equal(self.rows, self.previous_rows):
+            self.reduce(frame, 0, self.columns)
+            unchanged = self.columns_valid and np.array_equal(self.columns, self.previous_columns)
+            self.columns, self.previous_columns = self.previous_columns, self.columns
+            self.columns_valid = True
+            if unchanged and not self.forced:
+                self.skipped_frames += 1
+                self.changed_tiles = []
+                return False
+            if self.report_tiles:
+                self.set_changed_tiles(self.find_changed_tiles(width, height, False) if unchanged else
+                                       [(0, 0, width, height)])
+        else:
+            if self.report_tiles:
+                # Для плиток нужны и суммы столбцов этого кадра
+                self.reduce(frame, 0, self.columns)
+                self.set_changed_tiles(self.find_changed_tiles(width, height, self.columns_valid))
+                self.columns, self.previous_columns = self.previous_columns, self.columns
+            self.columns_valid = self.report_tiles
+            self.rows, self.previous_rows = self.previous_rows, self.rows
+        self.forced = False
+        return True
+
+    def set_changed_tiles(self, tiles):
+        self.changed_tiles = tiles
+        self.changed_tiles_total += len(tiles)
+
+    def find_changed_tiles(self, width, height, columns_known=True):
+        # Плитки (x, y, w, h) на пересечении измененных полос строк и столбцов: по суммам
+        # изменения локализуются с запасом (два изменения по диагонали дают четыре плитки)
+        size = self.tile_size
+        rows = np.unique(np.nonzero(self.rows[:, 0] != self.previous_rows[:, 0])[0] // size)
+        columns = []
+        if columns_known:
+            changed = (self.columns[0] != self.previous_columns[0]).reshape(width, -1).any(axis=1)
+            columns = np.unique(np.nonzero(changed)[0] // size)
+        # Изменение, сохранившее суммы по одной оси, затрагивает всю ее длину
+        if not len(rows):
+            rows = range(-(-height // size))
+        if not len(columns):
+            columns = range(-(-width // size))
+        return [(int(col) * size, int(row) * size, min(size, width - int(col) * size), min(size, height - int(row) * size))
+                for row in rows for col in columns]
+
+
+def mux_audio(video_filename, audio_filename, ffmpeg_path="ffmpeg"):
+    # Сведение WAV-дорожки с готовым видео без перекодирования видео. Без ffmpeg
+    # звук остается рядом отдельным WAV-файлом
+    ffmpeg = find_ffmpeg(ffmpeg_path)
+    if not ffmpeg:
+        print(f"ffmpeg не найден, звук сохранен отдельно: {os.path.abspath(audio_filename)}")
+        return False
+    root, extension = os.path.splitext(video_filename)
+    muxed_filename = root + ".muxed" + extension
+    result = run_ffmpeg(ffmpeg, ["-i", video_filename, "-i", audio_filename,
+                                 "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", AUDIO_CODECS.get(extension.lower(), "aac"),
+                                 muxed_filename])
+    if result.returncode != 0:
+        print(f"Не удалось свести звук с видео, звук сохранен отдельно: {os.path.abspath(audio_filename)}")
+        if os.path.exists(muxed_filename):
+            os.remove(muxed_filename)
+        return False
+    os.replace(muxed_filename, video_filename)
+    return True
+
+
+def concat_list_filename(output_filename):
+    return output_filename + ".concat.txt"
+
+
+def concat_videos(filenames, output_filename, ffmpeg_path="ffmpeg"):
+    # Склейка файлов одного формата через ffmpeg без перекодирования (concat demuxer).
+    # Перекодировать всю запись при остановке слишком долго, поэтому без ffmpeg или при ошибке
+    # части остаются как есть вместе со списком для склейки (concat_list_filename)
+    list_filename = concat_list_filename(output_filename)
+    with open(list_filename, "w", encoding="utf-8") as f:
+        for filename in filenames:
+            escaped = os.path.abspath(filename).replace("\\", "/").replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    ffmpeg = find_ffmpeg(ffmpeg_path)
+    if not ffmpeg:
+        print(f"ffmpeg не найден, части сохранены отдельно, список для склейки: {os.path.abspath(list_filename)}")
+        return False
+    result = run_ffmpeg(ffmpeg, ["-f", "concat", "-safe", "0", "-i", list_filename, "-c", "copy", output_filename])
+    if result.returncode != 0:
+        print(f"Не удалось склеить части, они сохранены отдельно, список: {os.path.abspath(list_filename)}")
+        return False
+    os.remove(list_filename)
+    return True
+
+
+def segment_worker(shm_name, shape, depth, tasks, done, video_format, fps, encoder_options, target_size, interpolation):
+    # Процесс пула: масштабирует и конвертирует кадры из общей памяти, кодирует свои сегменты в отдельные файлы
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((depth,) + tuple(shape), dtype=np.uint8, buffer=shm.buf)
+    scaler = FrameScaler((shape[1], shape[0]), target_size, interpolation)
+    img_bgr = np.empty((target_size[1], target_size[0], 3), dtype=np.uint8)
+    writer = None
+    filename = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == "open":
+            writer, filename = create_video_writer(task[2], video_format, fps, target_size, **encoder_options)
+            sequence = task[1]
+        elif task[0] == "frame":
+            _, index, repeat = task
+            try:
+                if index is not None:
+                    cv2.cvtColor(scaler.scale(frames[index]), cv2.COLOR_BGRA2BGR, dst=img_bgr)
+                    write_repeated(writer, img_bgr, repeat)
+                elif hasattr(writer, "extend_last"):
+                    writer.extend_last(repeat)
+                else:
+                    write_repeated(writer, img_bgr, repeat)
+            except Exception as e:
+                print(f"Ошибка кодирования кадра в процессе пула: {e}")
+            if index is not None:
+                done.put(("free", index))
+        elif task[0] == "close":
+            writer.release()
+            done.put(("segment", sequence, filename, getattr(writer, "error", None)))
+            writer = None
+    del frames
+    shm.close()
+
+
+class SegmentEncoderPool:
+    # Параллельное кодирование независимых сегментов (по GOP) в нескольких процессах.
+    # Кадры лежат в общей памяти кольца, процессам передаются только индексы слотов;
+    # при release() сегменты склеиваются в итоговый файл без перекодирования, поэтому
+    # пул используется только при найденном ffmpeg.
+    def __init__(self, base_filename, video_format, fps, size, workers, segment_frames, depth, encoder_options,
+                 target_size=None, interpolation="auto"):
+        width, height = size
+        self.shape = (height, width, 4)
+        self.depth = max(depth, workers * 2)
+        self.base_filename = base_filename
+        self.video_format = video_format
+        self.encoder_options = encoder_options
+        self.segment_frames = max(1, segment_frames)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.depth * height * width * 4)
+        self.done = multiprocessing.Queue()
+        self.tasks = [multiprocessing.Queue() for _ in range(workers)]
+        self.processes = [
+            multiprocessing.Process(target=segment_worker, daemon=True,
+                                    args=(self.shm.name, self.shape, self.depth, tasks, self.done, video_format, fps,
+                                          encoder_options, target_size or size, interpolation))
+            for tasks in self.tasks
+        ]
+        for process in self.processes:
+            process.start()
+        self.ring = None
+        self.segments = {}
+        self.sequence = 0
+        self.current_worker = None
+        self.frames_in_segment = 0
+        self.collector_thread = None
+        self.filename = None
+        self.error = None
+
+    def create_ring(self, policy):
+        self.ring = FrameRing(self.shape[:2] + (4,), self.depth, policy, buffer=self.shm.buf)
+        self.collector_thread = threading.Thread(target=self.collect)
+        self.collector_thread.start()
+        return self.ring
+
+    def isOpened(self):
+        return all(process.is_alive() for process in self.processes)
+
+    def collect(self):
+        while True:
+            message = self.done.get()
+            if message is None:
+                break
+            if message[0] == "free":
+                self.ring.release(message[1])
+            else:
+                self.segments[message[1]] = message[2]
+                if message[3]:
+                    self.error = message[3]
+
+    def dispatch_frames(self, ring, *args):
+        # Замена encode_frames: раздает слоты кольца процессам, сегмент целиком уходит одному процессу
+        # Сегмент закрывается только перед новым кадром, чтобы повторы (index None)
+        # всегда доставались процессу, у которого есть предыдущий кадр
+        while True:
+            item = ring.get()
+            if item is None:
+                if ring.closed:
+                    break
+                continue
+            index, repeat = item
+            if index is not None and self.frames_in_segment >= self.segment_frames:
+                self.close_segment()
+            if self.frames_in_segment == 0:
+                if index is None:
+                    continue
+                self.current_worker = self.tasks[self.sequence % len(self.tasks)]
+                self.current_worker.put(("open", self.sequence, f"{self.base_filename}_part{self.sequence:04d}"))
+            self.current_worker.put(("frame", index, repeat))
+            self.frames_in_segment += repeat
+
+    def close_segment(self):
+        if self.frames_in_segment:
+            self.current_worker.put(("close",))
+            self.sequence += 1
+            self.frames_in_segment = 0
+
+    def release(self):
+        self.close_segment()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        if self.collector_thread:
+            self.done.put(None)
+            self.collector_thread.join()
+        if self.ring:
+            self.ring.buffers = []
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        self.shm.unlink()
+
+        parts = [self.segments[sequence] for sequence in sorted(self.segments)]
+        if not parts:
+            return
+        if len(parts) == 1:
+            self.filename = self.base_filename + os.path.splitext(parts[0])[1]
+            os.replace(parts[0], self.filename)
+            return
+        output_filename = self.base_filename + os.path.splitext(parts[0])[1]
+        if concat_videos(parts, output_filename, self.encoder_options.get("ffmpeg_path", "ffmpeg")):
+            for part in parts:
+                os.remove(part)
+            self.filename = output_filename
+        else:
+            self.filename = concat_list_filename(output_filename)
+
+
+class SegmentedWriter:
+    # Запись с ротацией файлов каждые rotate_frames кадров или rotate_bytes байт.
+    # Закрытые сегменты сразу пригодны для просмотра, их список с номерами кадров ведется
+    # в манифесте <base>.manifest.json, поэтому после сбоя теряется только текущий сегмент.
+    # Остановка закрывает только текущий сегмент; по желанию (concat) сегменты склеиваются
+    # через ffmpeg без перекодирования, без ffmpeg остаются сегменты и манифест.
+    SIZE_CHECK_FRAMES = 30
+
+    def __init__(self, base_filename, video_format, fps, size, rotate_frames=0, rotate_bytes=0, concat=False, encoder_options=None):
+        self.base_filename = base_filename
+        self.video_format = video_format
+        self.fps = fps
+        self.size = size
+        self.rotate_frames = rotate_frames
+        self.rotate_bytes = rotate_bytes
+        self.concat = concat
+        self.encoder_options = encoder_options or {}
+        self.manifest_filename = base_filename + ".manifest.json"
+        self.segments = []
+        self.frames_total = 0
+        self.writer = None
+        self.current_filename = None
+        self.filename = None
+        self.error = None
+        self.last_frame = None
+        self.open_segment()
+
+    def open_segment(self):
+        index = len(self.segments)
+        self.writer, self.current_filename = create_video_writer(
+            f"{self.base_filename}_part{index:04d}", self.video_format, self.fps, self.size, **self.encoder_options)
+        self.segments.append({"file": os.path.basename(self.current_filename), "start_frame": self.frames_total,
+                              "frames": 0, "width": self.size[0], "height": self.size[1],
+                              "started": datetime.now().isoformat(timespec="seconds"), "complete": False})
+        self.save_manifest()
+
+    def close_segment(self):
+        self.writer.release()
+        self.error = getattr(self.writer, "error", None) or self.error
+        self.segments[-1]["complete"] = True
+        self.save_manifest()
+
+    def save_manifest(self):
+        manifest = {"fps": self.fps, "width": self.size[0], "height": self.size[1],
+                    "format": self.video_format, "segments": self.segments}
+        temporary = self.manifest_filename + ".tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=4, ensure_ascii=False)
+            os.replace(temporary, self.manifest_filename)
+        except OSError as e:
+            print(f"Не удалось обновить манифест сегментов: {e}")
+
+    def should_rotate(self):
+        frames = self.segments[-1]["frames"]
+        if self.rotate_frames and frames >= self.rotate_frames:
+            return True
+        if self.rotate_bytes and frames and frames % self.SIZE_CHECK_FRAMES == 0:
+            try:
+                return os.path.getsize(self.current_filename) >= self.rotate_bytes
+            except OSError:
+                return False
+        return False
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def reconfigure(self, size, preset=None):
+        # Новый размер кадра или пресет начинают новый сегмент (для LoadController)
+        if tuple(size) == tuple(self.size) and (preset is None or preset == self.encoder_options.get("preset")):
+            return
+        self.close_segment()
+        self.size = tuple(size)
+        if preset is not None:
+            self.encoder_options = dict(self.encoder_options, preset=preset)
+        self.open_segment()
+
+    def write(self, frame):
+        if self.should_rotate():
+            self.close_segment()
+            self.open_segment()
+        self.writer.write(frame)
+        self.last_frame = frame
+        self.segments[-1]["frames"] += 1
+        self.frames_total += 1
+
+    def extend_last(self, count):
+        # Повтор кадра остается в текущем сегменте; кодировщик без extend_last получает кадр еще раз
+        # (last_frame - буфер вызывающего кода, он не меняется до следующего write)
+        if hasattr(self.writer, "extend_last"):
+            self.writer.extend_last(count)
+        else:
+            for _ in range(count):
+                self.writer.write(self.last_frame)
+        self.segments[-1]["frames"] += count
+        self.frames_total += count
+
+    def release(self):
+        if self.writer is None:
+            return
+        self.close_segment()
+        self.writer = None
+
+        parts = [os.path.join(os.path.dirname(self.base_filename), segment["file"])
+                 for segment in self.segments if segment["frames"]]
+        # Сегменты разного размера без перекодирования не склеить
+        uniform = len({(segment["width"], segment["height"]) for segment in self.segments if segment["frames"]}) <= 1
+        if not self.concat or not parts or not uniform:
+            self.filename = self.manifest_filename
+            return
+        if not find_ffmpeg(self.encoder_options.get("ffmpeg_path", "ffmpeg")):
+            print(f"ffmpeg не найден, сегменты не склеены (см. {self.manifest_filename})")
+            self.filename = self.manifest_filename
+            return
+        output_filename = self.base_filename + os.path.splitext(parts[0])[1]
+        if concat_videos(parts, output_filename, self.encoder_options.get("ffmpeg_path", "ffmpeg")):
+            for filename in [os.path.join(os.path.dirname(self.base_filename), segment["file"]) for segment in self.segments]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            os.remove(self.manifest_filename)
+            self.filename = output_filename
+        else:
+            print(f"Не удалось склеить сегменты, они сохранены отдельно (см. {self.manifest_filename})")
+            self.filename = self.manifest_filename
+
+
+class ReplayBuffer:
+    # Режим "мгновенного повтора": VideoWriter-подобное кольцо последних кадров в памяти,
+    # сжатых в JPEG. Объем ограничен replay_megabytes и replay_seconds; flush() сохраняет
+    # последние секунды в файл в отдельном потоке, не останавливая захват.
+    def __init__(self, fps, size, seconds, megabytes, quality, video_format, encoder_options):
+        self.fps = fps
+        self.size = size
+        self.max_frames = max(1, int(fps * seconds))
+        self.max_bytes = int(megabytes * 1024 * 1024)
+        self.quality = quality
+        self.video_format = video_format
+        self.encoder_options = encoder_options
+        self.entries = deque()
+        self.frames = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def isOpened(self):
+        return True
+
+    def write(self, frame):
+        ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+        with self.lock:
+            self.entries.append([jpeg, 1])
+            self.frames += 1
+            self.bytes += jpeg.nbytes
+            self.trim()
+
+    def extend_last(self, count):
+        # Повтор прошлого кадра ничего не сжимает: увеличиваем счетчик последней записи
+        with self.lock:
+            if self.entries:
+                self.entries[-1][1] += count
+                self.frames += count
+                self.trim()
+
+    def trim(self):
+        while len(self.entries) > 1 and (self.bytes > self.max_bytes or self.frames - self.entries[0][1] >= self.max_frames):
+            jpeg, count = self.entries.popleft()
+            self.frames -= count
+            self.bytes -= jpeg.nbytes
+
+    def flush(self, base_filename, seconds=None, on_done=None):
+        with self.lock:
+            snapshot = [tuple(entry) for entry in self.entries]
+        thread = threading.Thread(target=self.write_file, args=(snapshot, base_filename, seconds, on_done))
+        thread.start()
+        return thread
+
+    def write_file(self, snapshot, base_filename, seconds, on_done):
+        needed = int(self.fps * seconds) if seconds else self.max_frames
+        selected = []
+        for jpeg, count in reversed(snapshot):
+            if needed <= 0:
+                break
+            selected.append((jpeg, min(count, needed)))
+            needed -= count
+        selected.reverse()
+        if not selected:
+            print("Буфер повтора пуст")
+            return
+
+        writer, filename = create_video_writer(base_filename, self.video_format, self.fps, self.size, **self.encoder_options)
+        if not writer.isOpened():
+            print(f"Не удалось сохранить повтор в формате {self.video_format}")
+            return
+        for jpeg, count in selected:
+            write_repeated(writer, cv2.imdecode(jpeg, cv2.IMREAD_COLOR), count)
+        writer.release()
+        if getattr(writer, "error", None):
+            print(f"Не удалось сохранить повтор: {writer.error}")
+            return
+        print(f"Повтор сохранен в: {os.path.abspath(filename)}")
+        if on_done:
+            on_done(filename)
+
+    def release(self):
+        with self.lock:
+            self.entries.clear()
+            self.frames = 0
+            self.bytes = 0
+
+
+class FrameSpool:
+    # Режим "записать сейчас, закодировать потом": BGRA-кадры без конвертации (или сжатые LZ4)
+    # с временными метками складываются в заранее выделенный файл, отображенный в память.
+    # Устройство файла: заголовок 4 КБ (сигнатура, счетчики, JSON с параметрами записи),
+    # таблица кадров (время, число повторов, длина данных) и слоты фиксированного размера.
+    # В видео спул превращает SpoolTranscoder.
+    MAGIC = b"BDSPOOL1"
+    HEADER_SIZE = 4096
+    INDEX_FIELDS = [("timestamp", "<f8"), ("repeat", "<u4"), ("length", "<u4")]
+    INDEX_ITEM_SIZE = 16
+    # Счетчики заголовка: записано кадров, перекодировано кусков, запись завершена
+    ENTRIES, CHUNKS_DONE, FINISHED = range(3)
+
+    def __init__(self, filename, metadata=None, limit_bytes=0):
+        # С metadata создается новый спул, без нее открывается существующий
+        self.filename = filename
+        self.full = False
+        if metadata is not None:
+            self.create(metadata, limit_bytes)
+        else:
+            self.open()
+        self.position = 0
+        if self.entries_written():
+            last = self.index[self.entries_written() - 1]
+            self.position = int(round(last["timestamp"] * self.metadata["fps"])) + int(last["repeat"])
+
+    def create(self, metadata, limit_bytes):
+        width, height = metadata["size"]
+        raw_size = width * height * 4
+        if metadata.get("compression") == "lz4":
+            if optional_import("lz4.block") is None:
+                print("Пакет lz4 не установлен, кадры спула пишутся без сжатия.")
+                metadata["compression"] = "none"
+            else:
+                raw_size += raw_size // 255 + 16
+        slot_size = (raw_size + 4095) // 4096 * 4096
+        slots = max(1, (limit_bytes - self.HEADER_SIZE) // (slot_size + self.INDEX_ITEM_SIZE))
+        metadata.update(slot_size=slot_size, slots=slots)
+        encoded = json.dumps(metadata).encode("utf-8")
+        if 64 + len(encoded) > self.HEADER_SIZE:
+            raise ValueError("Параметры записи не помещаются в заголовок спула")
+
+        index_size = (slots * self.INDEX_ITEM_SIZE + 4095) // 4096 * 4096
+        with open(self.filename, "wb") as f:
+            # Файл сразу получает полный размер (на большинстве ФС - без записи нулей на диск)
+            f.truncate(self.HEADER_SIZE + index_size + slots * slot_size)
+            f.write(self.MAGIC)
+            f.seek(32)
+            f.write(np.array([len(encoded)], dtype="<u8").tobytes())
+            f.seek(64)
+            f.write(encoded)
+        self.open()
+
+    def open(self):
+        self.memmap = np.memmap(self.filename, dtype=np.uint8, mode="r+")
+        if bytes(self.memmap[:8]) != self.MAGIC:
+            raise ValueError(f"Файл не является спулом записи: {self.filename}")
+        self.counters = self.memmap[8:32].view("<u8")
+        length = int(self.memmap[32:40].view("<u8")[0])
+        self.metadata = json.loads(bytes(self.memmap[64:64 + length]).decode("utf-8"))
+        slots, slot_size = self.metadata["slots"], self.metadata["slot_size"]
+        index_size = (slots * self.INDEX_ITEM_SIZE + 4095) // 4096 * 4096
+        self.index = self.memmap[self.HEADER_SIZE:self.HEADER_SIZE + slots * self.INDEX_ITEM_SIZE].view(np.dtype(self.INDEX_FIELDS))
+        data_offset = self.HEADER_SIZE + index_size
+        self.data = self.memmap[data_offset:data_offset + slots * slot_size].reshape(slots, slot_size)
+        self.lz4 = optional_import("lz4.block") if self.metadata["compression"] == "lz4" else None
+
+    def isOpened(self):
+        return self.memmap is not None
+
+    def entries_written(self):
+        return int(self.counters[self.ENTRIES])
+
+    def append(self, frame, repeat=1):
+        # Возвращает False, если спул заполнен (лимит spool_megabytes)
+        entry = self.entries_written()
+        if entry >= len(self.index):
+            self.full = True
+            return False
+        slot = self.data[entry]
+        if self.metadata["compression"] == "lz4":
+            compressed = self.lz4.compress(frame, store_size=False)
+            slot[:len(compressed)] = np.frombuffer(compressed, dtype=np.uint8)
+            length = len(compressed)
+        else:
+            length = frame.nbytes
+            np.copyto(slot[:length].reshape(frame.shape), frame)
+        self.index[entry] = (self.position / self.metadata["fps"], repeat, length)
+        self.position += repeat
+        # Счетчик увеличивается последним: читатель видит только полностью записанные кадры
+        self.counters[self.ENTRIES] = entry + 1
+        return True
+
+    def extend_last(self, count):
+        entry = self.entries_written()
+        if entry:
+            self.index[entry - 1]["repeat"] += count
+            self.position += count
+
+    def frame(self, entry):
+        width, height = self.metadata["size"]
+        length = int(self.index[entry]["length"])
+        if self.metadata["compression"] == "lz4":
+            raw = self.lz4.decompress(self.data[entry, :length].tobytes(), uncompressed_size=width * height * 4)
+            return np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+        return self.data[entry, :length].reshape(height, width, 4)
+
+    def finish(self):
+        self.counters[self.FINISHED] = 1
+        self.memmap.flush()
+
+    def release(self):
+        if self.memmap is None:
+            return
+        self.finish()
+        self.close()
+
+    def close(self):
+        if self.memmap is not None:
+            self.memmap.flush()
+        self.memmap = None
+        self.counters = self.index = self.data = None
+
+
+class SpoolTranscoder:
+    # Перекодирует спул в видео кусками по chunk_seconds: каждый кусок - отдельный файл,
+    # число готовых кусков хранится в заголовке спула. Если программу закрыли посреди
+    # перекодирования, следующий запуск продолжит с незаконченного куска (resume_spools).
+    # Может работать параллельно с записью, отставая от нее, или после остановки.
+    # resume=True - спул от прерванной сессии: дописывать его больше некому.
+    def __init__(self, filename, resume=False, on_done=None):
+        self.filename = filename
+        self.resume = resume
+        self.on_done = on_done
+        self.output_filename = None
+        self.thread = None
+
+    def start(self):
+        # Поток-демон: при закрытии программы перекодирование просто продолжится в следующий раз
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def run(self):
+        try:
+            self.transcode()
+        except Exception as e:
+            print(f"Ошибка перекодирования спула {self.filename}: {e}")
+
+    def transcode(self):
+        spool = FrameSpool(self.filename)
+        metadata = spool.metadata
+        chunk_entries = max(1, int(metadata["fps"] * metadata["chunk_seconds"]))
+        if not find_ffmpeg(metadata["encoder_options"].get("ffmpeg_path", "ffmpeg")):
+            # Без ffmpeg куски не склеить без перекодирования: весь спул кодируется одним куском
+            # после окончания записи (прерванное перекодирование начнется заново)
+            chunk_entries = max(chunk_entries, spool.metadata["slots"])
+        while True:
+            written = spool.entries_written()
+            finished = self.resume or spool.counters[FrameSpool.FINISHED]
+            begin = int(spool.counters[FrameSpool.CHUNKS_DONE]) * chunk_entries
+            end = begin + chunk_entries
+            if finished and begin >= written:
+                break
+            # Последний кадр идущей записи еще может получить повторы - его не трогаем
+            if not finished and end > written - 1:
+                time.sleep(0.2)
+                continue
+            self.encode_chunk(spool, begin, min(end, written), int(spool.counters[FrameSpool.CHUNKS_DONE]))
+            spool.counters[FrameSpool.CHUNKS_DONE] += 1
+            spool.memmap.flush()
+        spool.close()
+        self.finish(metadata)
+
+    def part_base(self, metadata, chunk):
+        return f"{metadata['base_filename']}.part{chunk:04d}"
+
+    def encode_chunk(self, spool, begin, end, chunk):
+        metadata = spool.metadata
+        base_filename = self.part_base(metadata, chunk)
+        # Незаконченный кусок от прерванного перекодирования пишется заново
+        for stale in self.parts(metadata, chunk):
+            os.remove(stale)
+        target_size = tuple(metadata["target_size"])
+        writer, filename = create_video_writer(base_filename, metadata["video_format"], metadata["fps"], target_size,
+                                               **metadata["encoder_options"])
+        if not writer.isOpened():
+            raise RuntimeError(f"Не удалось инициализировать VideoWriter для формата {metadata['video_format']}")
+        scaler = FrameScaler(tuple(metadata["size"]), target_size, metadata["interpolation"])
+        img_bgr = np.empty((target_size[1], target_size[0], 3), dtype=np.uint8)
+        for entry in range(begin, end):
+            cv2.cvtColor(scaler.scale(spool.frame(entry)), cv2.COLOR_BGRA2BGR, dst=img_bgr)
+            write_repeated(writer, img_bgr, int(spool.index[entry]["repeat"]))
+        writer.release()
+        if getattr(writer, "error", None):
+            raise RuntimeError(writer.error)
+
+    def parts(self, metadata, chunk=None):
+        folder = os.path.dirname(os.path.abspath(metadata["base_filename"])) or "."
+        prefix = os.path.basename(metadata["base_filename"]) + ".part"
+        names = sorted(name for name in os.listdir(folder) if name.startswith(prefix))
+        if chunk is not None:
+            names = [name for name in names if name.startswith(f"{prefix}{chunk:04d}.")]
+        return [os.path.join(folder, name) for name in names]
+
+    def finish(self, metadata):
+        parts = self.parts(metadata)
+        if parts:
+            self.output_filename = metadata["base_filename"] + os.path.splitext(parts[0])[1]
+            if len(parts) == 1:
+                os.replace(parts[0], self.output_filename)
+            elif concat_videos(parts, self.output_filename, metadata["encoder_options"].get("ffmpeg_path", "ffmpeg")):
+                for part in parts:
+                    os.remove(part)
+            else:
+                return
+            audio_filename = metadata.get("audio_filename")
+            if audio_filename and os.path.exists(audio_filename):
+                if mux_audio(self.output_filename, audio_filename, metadata["encoder_options"].get("ffmpeg_path", "ffmpeg")):
+                    os.remove(audio_filename)
+            print(f"Видео сохранено в: {os.path.abspath(self.output_filename)}")
+        os.remove(self.filename)
+        if self.on_done:
+            self.on_done(self.output_filename)
+
+
+def resume_spools(folder):
+    # Продолжает перекодирование спулов, оставшихся от прошлых запусков
+    transcoders = []
+    if not os.path.isdir(folder):
+        return transcoders
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(".spool"):
+            print(f"Продолжается перекодирование спула: {name}")
+            transcoders.append(SpoolTranscoder(os.path.join(folder, name), resume=True).start())
+    return transcoders
+
+
+class PipelineStats:
+    # Время этапов конвейера (grab, detect, copy, convert, write): скользящее окно из samples
+    # последних замеров каждого этапа для перцентилей и гистограмм плюс общие счетчики,
+    # а также мгновенные значения (глубина очереди). Каждый этап пишет только один поток,
+    # поэтому замер обходится без блокировок.
+    HISTOGRAM_EDGES_MS = (0, 0.5, 1, 2, 4, 8, 16, 33, 66, float("inf"))
+
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self.durations = {}
+        self.counts = {}
+        self.totals = {}
+        self.gauges = {}
+        self.gauge_peaks = {}
+
+    def add(self, stage, seconds):
+        durations = self.durations.get(stage)
+        if durations is None:
+            durations = self.durations[stage] = np.zeros(self.samples)
+            self.counts[stage] = 0
+            self.totals[stage] = 0.0
+        durations[self.counts[stage] % self.samples] = seconds
+        self.counts[stage] += 1
+        self.totals[stage] += seconds
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+        if value > self.gauge_peaks.get(name, value - 1):
+            self.gauge_peaks[name] = value
+
+    def recent_ms(self, stage):
+        count = self.counts.get(stage, 0)
+        return self.durations[stage][:min(count, self.samples)] * 1000 if count else None
+
+    def histogram(self, stage):
+        # Число замеров из скользящего окна по интервалам HISTOGRAM_EDGES_MS
+        recent = self.recent_ms(stage)
+        if recent is None:
+            return []
+        counts, _ = np.histogram(recent, bins=self.HISTOGRAM_EDGES_MS)
+        return [int(count) for count in counts]
+
+    def summary(self):
+        result = {}
+        for stage, durations in list(self.durations.items()):
+            count = self.counts[stage]
+            if not count:
+                continue
+            recent = durations[:min(count, self.samples)] * 1000
+            p50, p90, p99 = np.percentile(recent, [50, 90, 99])
+            result[stage] = {
+                "count": count,
+                "mean_ms": round(self.totals[stage] / count * 1000, 3),
+                "p50_ms": round(float(p50), 3),
+                "p90_ms": round(float(p90), 3),
+                "p99_ms": round(float(p99), 3),
+                "max_ms": round(float(recent.max()), 3),
+            }
+        return result
+
+
+class PresentationClock:
+    # Единые часы записи: монотонное время с начала записи без учета пауз.
+    # Пауза, продолжение и остановка фиксируются в момент вызова, а не на следующем кадре.
+    # По этим часам идут дедлайны кадров, раскладка звука и таймер окна,
+    # поэтому длительность файла совпадает с показанной.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.pause_start = None
+        self.paused_duration = 0.0
+        self.pauses = []
+
+    def start(self):
+        with self.lock:
+            self.start_time = time.monotonic()
+            # Пауза, нажатая до начала захвата, начинается вместе с ним
+            if self.pause_start is not None:
+                self.pause_start = self.start_time
+
+    def pause(self):
+        with self.lock:
+            if self.pause_start is None:
+                self.pause_start = time.monotonic()
+
+    def resume(self):
+        with self.lock:
+            if self.pause_start is None:
+                return
+            if self.start_time is not None:
+                now = time.monotonic()
+                self.paused_duration += now - self.pause_start
+                self.pauses.append((self.pause_start, now))
+            self.pause_start = None
+
+    def stop(self):
+        # После остановки время записи замирает, как на паузе
+        self.pause()
+
+    @property
+    def started(self):
+        return self.start_time is not None
+
+    def elapsed(self):
+        with self.lock:
+            if self.start_time is None:
+                return 0.0
+            now = self.pause_start if self.pause_start is not None else time.monotonic()
+            return max(0.0, now - self.start_time - self.paused_duration)
+
+    def monotonic_at(self, position):
+        # Момент монотонных часов, когда время записи достигнет position (без учета будущих пауз)
+        with self.lock:
+            return self.start_time + self.paused_duration + position
+
+    def presentation_time(self, timestamp):
+        # Время записи для момента монотонных часов (например, начала звукового блока)
+        # или None, если в этот момент запись стояла на паузе
+        with self.lock:
+            if self.start_time is None:
+                return None
+            if self.pause_start is not None and timestamp >= self.pause_start:
+                return None
+            paused = 0.0
+            for started, ended in self.pauses:
+                if timestamp >= ended:
+                    paused += ended - started
+                elif timestamp >= started:
+                    return None
+            return timestamp - self.start_time - paused
+
+
+class FrameScheduler:
+    # Планировщик кадров по абсолютным дедлайнам часов записи (PresentationClock).
+    # Число кадров в файле всегда соответствует времени записи без учета пауз:
+    # при отставании кадр дублируется, лишний кадр отбрасывается.
+    # interval - время записи на один кадр файла: 1 / fps, а для таймлапса - период съемки
+    def __init__(self, fps, clock=None, interval=None):
+        self.fps = fps
+        self.interval = interval or 1 / fps
+        self.clock = clock or PresentationClock()
+        self.stride = 1
+        self.captured_frames = 0
+        self.written_frames = 0
+        self.late_frames = 0
+        self.duplicated_frames = 0
+        # Повторы из-за пониженной частоты захвата (stride) - плановые, в потери не входят
+        self.stride_frames = 0
+        self.dropped_frames = 0
+        # Будит ожидание следующего кадра при паузе и остановке: в таймлапсе оно длится секунды
+        self.wakeup = threading.Event()
+
+    def start(self):
+        if not self.clock.started:
+            self.clock.start()
+
+    def pause(self):
+        self.clock.pause()
+
+    def resume(self):
+        self.clock.resume()
+
+    def stop(self):
+        self.clock.stop()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def elapsed(self):
+        return self.clock.elapsed()
+
+    def set_capture_fps(self, capture_fps):
+        # Захват реже частоты файла: каждый захваченный кадр пишется stride раз
+        self.stride = max(1, round(self.fps / capture_fps))
+
+    def wait_next_frame(self):
+        deadline = self.clock.monotonic_at((self.written_frames + self.stride - 1) * self.interval)
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            # После пробуждения вызывающий код сам проверяет паузу и остановку
+            if self.wakeup.wait(delay):
+                self.wakeup.clear()
+        elif -delay > self.interval * self.stride:
+            self.late_frames += 1
+
+    def frames_due(self):
+        # Сколько раз записать только что захваченный кадр, чтобы догнать время записи
+        self.captured_frames += 1
+        due = int(self.elapsed() / self.interval) + 1
+        count = due - self.written_frames
+        if count <= 0:
+            self.dropped_frames += 1
+            return 0
+        self.count_repeats(count - 1)
+        self.written_frames = due
+        return count
+
+    def count_repeats(self, repeats):
+        # Первые stride - 1 повторов кадра предусмотрены сниженной частотой захвата, остальные - отставание
+        planned = min(repeats, self.stride - 1)
+        self.stride_frames += planned
+        self.duplicated_frames += repeats - planned
+
+    def frames_remaining(self):
+        # Сколько раз продлить последний кадр после остановки, чтобы длительность файла
+        # совпала с временем записи с точностью до кадра
+        count = max(0, round(self.elapsed() / self.interval) - self.written_frames)
+        self.count_repeats(count)
+        self.written_frames += count
+        return count
+
+    def capture_fps(self):
+        # Частота, с которой кадры должны захватываться сейчас: с учетом таймлапса и stride
+        return 1 / (self.interval * self.stride)
+
+    def achieved_fps(self):
+        elapsed = self.elapsed()
+        return self.captured_frames / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        return {
+            "target_fps": self.fps,
+            "achieved_fps": round(self.achieved_fps(), 2),
+            "captured_frames": self.captured_frames,
+            "written_frames": self.written_frames,
+            "late_frames": self.late_frames,
+            "duplicated_frames": self.duplicated_frames,
+            "stride_frames": self.stride_frames,
+            "dropped_frames": self.dropped_frames,
+            "duration": round(self.elapsed(), 3),
+            "capture_fps": round(self.capture_fps(), 2),
+            "output_seconds": round(self.written_frames / self.fps, 3),
+        }
+
+
+ENGINE_DEFAULTS = {
+    "queue_depth": 8,
+    "queue_policy": "drop-oldest",
+    "ffmpeg_path": "ffmpeg",
+    "ffmpeg_preset": "ultrafast",
+    "ffmpeg_crf": 23,
+    "ffmpeg_threads": 0,
+    "encode_workers": 0,
+    "segment_seconds": 2,
+    "change_detection": True,
+    "change_tile_size": 64,
+    "report_changed_tiles": False,
+    "stats_log": "",
+    "rotate_seconds": 0,
+    "rotate_megabytes": 0,
+    "concat_segments": False,
+    "fragmented_mp4": False,
+    "replay_seconds": 30,
+    "replay_megabytes": 200,
+    "replay_quality": 80,
+    "output_scale": 1.0,
+    "output_width": 0,
+    "output_height": 0,
+    "scale_interpolation": "auto",
+    "monitor": 1,
+    "audio_source": "",
+    "audio_samplerate": 48000,
+    "audio_channels": 2,
+    "draw_cursor": False,
+    "highlight_clicks": True,
+    "cursor_scale": 1.0,
+    "spool": False,
+    "spool_megabytes": 4096,
+    "spool_compression": "none",
+    "spool_transcode": "after",
+    "spool_chunk_seconds": 10,
+    "adaptive": False,
+    "adaptive_min_fps": 10,
+    "adaptive_min_scale": 0.5,
+    "adaptive_fastest_preset": "ultrafast",
+    "capture_mode": "normal",
+    "timelapse_interval": 5.0,
+}
+
+# Режимы записи: обычный, таймлапс (кадр раз в timelapse_interval секунд, воспроизведение с fps)
+# и переменная частота кадров (в файл попадают только изменившиеся кадры)
+CAPTURE_MODES = ("normal", "timelapse", "vfr")
+CAPTURE_MODE_NAMES = {"Обычный": "normal", "Таймлапс": "timelapse", "VFR": "vfr"}
+
+
+class LoadController:
+    # Адаптация к нагрузке. Раз в секунду сравнивает время работы захвата на кадр с интервалом
+    # кадра и заполненность очереди кодирования. При перегрузке делает шаг вниз по лестнице
+    # уровней (быстрее пресет -> меньше масштаб -> реже захват), при устойчиво низкой
+    # нагрузке - шаг обратно. Границы берутся из настроек, каждое изменение пишется в журнал.
+    HIGH_LOAD = 0.85
+    LOW_LOAD = 0.5
+    STEP_DOWN_WINDOWS = 2
+    STEP_UP_WINDOWS = 5
+
+    def __init__(self, fps, min_fps=10, scale=1.0, min_scale=1.0, preset=None, fastest_preset="ultrafast", window=1.0):
+        # preset=None - пресет не регулируется; min_scale=scale - масштаб не регулируется
+        self.levels = [(fps, scale, preset)]
+        if preset in FFMPEG_PRESETS:
+            fastest = FFMPEG_PRESETS.index(fastest_preset) if fastest_preset in FFMPEG_PRESETS else 0
+            for index in range(FFMPEG_PRESETS.index(preset) - 1, fastest - 1, -1):
+                preset = FFMPEG_PRESETS[index]
+                self.levels.append((fps, scale, preset))
+        while scale * 0.75 >= min_scale - 1e-9:
+            scale = round(scale * 0.75, 3)
+            self.levels.append((fps, scale, preset))
+        # FPS захвата снижается целыми делителями: файл остается с исходной частотой кадров
+        capture_fps = fps
+        while capture_fps / 2 >= min_fps:
+            capture_fps = capture_fps // 2 if capture_fps % 2 == 0 else capture_fps / 2
+            self.levels.append((capture_fps, scale, preset))
+        self.level = 0
+        self.version = 0
+        self.adjustments = []
+        self.window = window
+        self.window_start = time.monotonic()
+        self.work = 0.0
+        self.frames = 0
+        self.queue_fill = 0.0
+        self.high_windows = 0
+        self.low_windows = 0
+
+    @property
+    def capture_fps(self):
+        return self.levels[self.level][0]
+
+    @property
+    def scale(self):
+        return self.levels[self.level][1]
+
+    @property
+    def preset(self):
+        return self.levels[self.level][2]
+
+    def observe(self, work_seconds, queue_fill):
+        # Вызывается потоком захвата на каждый кадр; возвращает True, если уровень изменился
+        self.work += work_seconds
+        self.frames += 1
+        self.queue_fill = max(self.queue_fill, queue_fill)
+        now = time.monotonic()
+        if now - self.window_start < self.window:
+            return False
+        load = max(self.work / self.frames * self.capture_fps, self.queue_fill)
+        self.window_start = now
+        self.work = 0.0
+        self.frames = 0
+        self.queue_fill = 0.0
+
+        if load > self.HIGH_LOAD:
+            self.high_windows += 1
+            self.low_windows = 0
+        elif load < self.LOW_LOAD:
+            self.low_windows += 1
+            self.high_windows = 0
+        else:
+            self.high_windows = self.low_windows = 0
+        if self.high_windows >= self.STEP_DOWN_WINDOWS and self.level < len(self.levels) - 1:
+            return self.step(1, load)
+        if self.low_windows >= self.STEP_UP_WINDOWS and self.level > 0:
+            return self.step(-1, load)
+        return False
+
+    def step(self, direction, load):
+        before = self.levels[self.level]
+        self.level += direction
+        after = self.levels[self.level]
+        self.version += 1
+        self.high_windows = self.low_windows = 0
+        entry = {"time": datetime.now().isoformat(timespec="milliseconds"), "load": round(load, 2),
+                 "capture_fps": after[0], "scale": after[1], "preset": after[2]}
+        self.adjustments.append(entry)
+        changes = [f"{name} {old} -> {new}" for name, old, new in zip(("FPS захвата", "масштаб", "пресет"), before, after) if old != new]
+        print(f"[{entry['time']}] Нагрузка {load:.2f}: {', '.join(changes)}")
+        return True
+
+
+def load_engine_options(path="settings.json"):
+    # Параметры движка из settings.json (общий файл с окном), недостающие берутся по умолчанию
+    options = dict(ENGINE_DEFAULTS)
+    try:
+        with open(path, "r") as f:
+            settings = json.load(f)
+        for key in options:
+            options[key] = settings.get(key, options[key])
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    return options
+
+
+class CaptureTrack:
+    # Одна выходная запись движка: область внутри общего захваченного кадра и свой конвейер кодирования.
+    # name добавляется к именам этапов статистики, чтобы у каждого этапа оставался один поток-писатель.
+    def __init__(self, name, origin, offset, size, target_size, base_filename):
+        self.name = name
+        self.left, self.top = origin
+        self.x, self.y = offset
+        self.width, self.height = size
+        self.target_size = target_size
+        self.base_filename = base_filename
+        self.output_filename = ""
+        self.video_writer = None
+        self.frame_ring = None
+        self.encode_thread = None
+        self.change_detector = None
+        self.cursor_state = None
+
+
+class RecordingEngine:
+    # Движок захвата и кодирования без зависимости от Tk. Используется окном ScreenRecorder,
+    # командой "python bandicam.py record" и из скриптов:
+    #     engine = RecordingEngine({"left": 0, "top": 0, "width": 1280, "height": 720}, fps=60)
+    #     engine.start(); time.sleep(30); engine.stop()
+    # region=None означает монитор из настройки monitor (0 - все мониторы одной картинкой, "each" - каждый
+    # в свой файл); также можно передать номер монитора, область или список номеров/областей -
+    # тогда все они записываются одновременно в отдельные файлы из одного захвата.
+    # source - источник кадров (по умолчанию экран через mss).
+    # replay=True включает буфер повтора: кадры копятся в памяти, файл пишет flush_replay().
+    # Скриншот из конвейера ждет следующего кадра не дольше SNAPSHOT_MAX_WAIT секунд (иначе - отдельный захват)
+    SNAPSHOT_MAX_WAIT = 0.2
+
+    def __init__(self, region=None, fps=30, output_folder=None, video_format=".wmv", base_filename=None, source=None,
+                 replay=False, **options):
+        self.region = region
+        self.source = source or MssSource()
+        self.replay = replay
+        self.fps = fps if fps and fps > 0 else 30
+        self.output_folder = output_folder or os.getcwd()
+        self.video_format = video_format
+        self.base_filename = base_filename
+        for key, value in ENGINE_DEFAULTS.items():
+            setattr(self, key, options.pop(key, value))
+        if options:
+            raise TypeError(f"Неизвестные параметры записи: {', '.join(options)}")
+
+        # Колбэки вызываются из потока записи
+        self.on_error = None
+        self.on_finished = None
+
+        self.recording = False
+        self.paused = False
+        self.error = None
+        self.record_thread = None
+        self.tracks = []
+        self.clock = PresentationClock()
+        self.frame_scheduler = None
+        self.audio_recorder = None
+        self.audio_filename = None
+        self.cursor_overlay = None
+        self.load_controller = None
+        self.pending_region = None
+        self.start_time = None
+        self.first_frame_time = None
+        self.transcoders = []
+        self.stats = PipelineStats()
+        self.live_snapshot = None
+        self.snapshot_requests = deque()
+        self.snapshot_lock = threading.Lock()
+        self.snapshots_open = False
+
+    def start(self):
+        if self.recording:
+            return
+        self.recording = True
+        self.paused = False
+        self.error = None
+        self.clock = PresentationClock()
+        self.frame_scheduler = None
+        self.pending_region = None
+        self.start_time = time.perf_counter()
+        self.first_frame_time = None
+        self.record_thread = threading.Thread(target=self.record_screen)
+        self.record_thread.start()
+
+    def pause(self):
+        self.clock.pause()
+        self.paused = True
+        if self.frame_scheduler:
+            self.frame_scheduler.wake()
+
+    def resume(self):
+        self.clock.resume()
+        self.paused = False
+
+    def elapsed(self):
+        # Время записи без пауз - то, что окажется в файле
+        return self.clock.elapsed()
+
+    def output_seconds(self):
+        # Длительность получающегося видео: в таймлапсе она меньше времени записи
+        scheduler = self.frame_scheduler
+        return scheduler.written_frames / scheduler.fps if scheduler else 0.0
+
+    def set_region(self, region):
+        # Перенос области записи во время записи (только положение: размер файла уже задан).
+        # Поток захвата применяет новое положение целиком перед следующим захватом
+        self.pending_region = (region["left"], region["top"])
+
+    def stop(self, timeout=None):
+        # Возвращает False, если поток записи не успел завершиться за timeout
+        self.clock.stop()
+        self.recording = False
+        if self.frame_scheduler:
+            self.frame_scheduler.wake()
+        if self.record_thread and self.record_thread is not threading.current_thread():
+            self.record_thread.join(timeout)
+            return not self.record_thread.is_alive()
+        return True
+
+    # Первая (для одной области - единственная) запись; остальные доступны через tracks
+    @property
+    def video_writer(self):
+        return self.tracks[0].video_writer if self.tracks else None
+
+    @property
+    def output_filename(self):
+        return self.tracks[0].output_filename if self.tracks else ""
+
+    @property
+    def output_filenames(self):
+        return [track.output_filename for track in self.tracks if track.output_filename]
+
+    def queue_dropped(self):
+        return sum(track.frame_ring.dropped for track in self.tracks if track.frame_ring)
+
+    def request_snapshot(self, callback, fallback):
+        # Копия следующего захваченного кадра (BGRA) для скриншота без второго захвата экрана;
+        # callback вызывается из потока захвата. Если следующий кадр далеко (таймлапс, сниженная частота),
+        # запись на паузе или уже завершается, вызывается fallback - обычный скриншот своим захватом
+        with self.snapshot_lock:
+            scheduler = self.frame_scheduler
+            if (self.snapshots_open and not self.paused and scheduler
+                    and scheduler.interval * scheduler.stride <= self.SNAPSHOT_MAX_WAIT):
+                self.snapshot_requests.append((callback, fallback))
+                return
+        fallback()
+
+    def hand_off_snapshots(self, close=False):
+        # Невыполненные запросы скриншота уходят в fallback; close - кадров для них больше не будет
+        with self.snapshot_lock:
+            requests = list(self.snapshot_requests)
+            self.snapshot_requests.clear()
+            if close:
+                self.snapshots_open = False
+        for callback, fallback in requests:
+            fallback()
+
+    def flush_replay(self, seconds=None, on_done=None):
+        # Сохраняет последние seconds секунд буфера повтора в output_folder, не блокируя захват
+        if not isinstance(self.video_writer, ReplayBuffer):
+            return None
+        base_filename = os.path.join(self.output_folder, f"replay_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+        return self.video_writer.flush(base_filename, seconds or self.replay_seconds, on_done)
+
+    def first_frame_seconds(self):
+        # Время от start() до первого захваченного кадра (с ленивыми импортами и открытием кодировщика)
+        if self.first_frame_time is None:
+            return None
+        return round(self.first_frame_time - self.start_time, 3)
+
+    def live_stats(self):
+        # Короткая сводка для окна: FPS за время с прошлого вызова, потери и очередь
+        scheduler = self.frame_scheduler
+        if scheduler is None:
+            return None
+        now = time.monotonic()
+        captured = scheduler.captured_frames
+        # Сравниваем с частотой захвата, а не воспроизведения: в таймлапсе это кадр раз в interval секунд,
+        # после снижения нагрузки (LoadController) - fps / stride
+        target_fps = scheduler.capture_fps()
+        fps = 0.0
+        if target_fps < 1:
+            # Между обновлениями окна таймлапс успевает снять не больше кадра: берем среднее за запись
+            fps = scheduler.achieved_fps()
+        elif self.live_snapshot and now > self.live_snapshot[1]:
+            fps = (captured - self.live_snapshot[0]) / (now - self.live_snapshot[1])
+        self.live_snapshot = (captured, now)
+
+        slowest = None
+        for stage, summary in self.stats.summary().items():
+            if slowest is None or summary["p90_ms"] > slowest[1]:
+                slowest = (stage, summary["p90_ms"])
+        return {
+            "fps": fps,
+            "target_fps": target_fps,
+            "dropped": scheduler.duplicated_frames + self.queue_dropped(),
+            "queue": max([value for name, value in self.stats.gauges.items() if name.startswith("queue")], default=0),
+            "slowest_stage": slowest,
+        }
+
+    def report(self):
+        report = {
+            "output": os.path.abspath(self.output_filename) if self.output_filename else "",
+            "outputs": [os.path.abspath(filename) for filename in self.output_filenames],
+            "adjustments": self.load_controller.adjustments if self.load_controller else [],
+            "first_frame_seconds": self.first_frame_seconds(),
+            "frames": self.frame_scheduler.stats() if self.frame_scheduler else {},
+            "queue_dropped": self.queue_dropped(),
+            "unchanged_frames": sum(track.change_detector.skipped_frames for track in self.tracks if track.change_detector),
+            "changed_tiles": {"tile_size": self.change_tile_size,
+                              "last": sum(len(track.change_detector.changed_tiles) for track in self.tracks if track.change_detector),
+                              "total": sum(track.change_detector.changed_tiles_total for track in self.tracks if track.change_detector)}
+            if self.report_changed_tiles else {},
+            "queue_depth": {"last": max([value for name, value in self.stats.gauges.items() if name.startswith("queue")], default=0),
+                            "max": max([value for name, value in self.stats.gauge_peaks.items() if name.startswith("queue")], default=0)},
+            "stages": self.stats.summary(),
+            "histogram_edges_ms": [edge for edge in PipelineStats.HISTOGRAM_EDGES_MS if edge != float("inf")],
+            "histograms": {stage: self.stats.histogram(stage) for stage in self.stats.durations},
+        }
+        return report
+
+    def write_stats_log(self):
+        # stats_log: "json" или "csv" - файл рядом с видео; пустая строка - не сохранять
+        if self.stats_log not in ("json", "csv") or not self.output_filename:
+            return
+        report = self.report()
+        filename = f"{self.output_filename}.stats.{self.stats_log}"
+        try:
+            if self.stats_log == "json":
+                with open(filename, "w", encoding="utf-8") as f:
+                    json.dump(report, f, indent=4, ensure_ascii=False)
+            else:
+                with open(filename, "w", newline="", encoding="utf-8") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["metric", "value"])
+                    for key, value in report["frames"].items():
+                        writer.writerow([f"frames.{key}", value])
+                    writer.writerow(["queue_dropped", report["queue_dropped"]])
+                    writer.writerow(["unchanged_frames", report["unchanged_frames"]])
+                    for key, value in report["changed_tiles"].items():
+                        writer.writerow([f"changed_tiles.{key}", value])
+                    writer.writerow(["queue_depth.max", report["queue_depth"]["max"]])
+                    for stage, summary in report["stages"].items():
+                        for key, value in summary.items():
+                            writer.writerow([f"{stage}.{key}", value])
+            print(f"Статистика записи сохранена в: {os.path.abspath(filename)}")
+        except OSError as e:
+            print(f"Не удалось сохранить статистику: {e}")
+
+    def report_error(self, message):
+        self.error = message
+        print(message)
+        if self.on_error:
+            self.on_error(message)
+
+    def record_screen(self):
+        try:
+            self.capture_frames()
+        except Exception as e:
+            self.report_error(f"Произошла ошибка во время записи: {e}")
+        finally:
+            self.recording = False
+            if self.on_finished:
+                self.on_finished()
+
+    def capture_frames(self):
+        self.source.open()
+        try:
+            self.capture_from_source(self.source)
+        finally:
+            self.source.close()
+
+    def resolve_regions(self, source):
+        # region: None (монитор из настройки monitor), номер монитора, словарь области или список таких значений
+        monitors = source.monitors()
+        if self.region is None:
+            regions = list(range(1, len(monitors))) if self.monitor == "each" else [int(self.monitor)]
+        elif isinstance(self.region, list):
+            regions = self.region
+        else:
+            regions = [self.region]
+        resolved = []
+        for region in regions:
+            if isinstance(region, int):
+                # Монитор могли отключить после сохранения настроек: пишем первый, как и скриншоты
+                if not 0 <= region < len(monitors):
+                    print(f"Монитор {region} не найден (доступно мониторов: {len(monitors) - 1}), запись с монитора 1.")
+                    region = 1
+                region = dict(monitors[region])
+            resolved.append(region)
+        return resolved
+
+    def writer_conflicts(self):
+        # Режимы записи взаимоисключающие: create_track_writer выбирает первый включенный
+        # (буфер повтора, спул, VFR, ротация, параллельное кодирование), остальные не действуют
+        modes = [("буфер повтора", self.replay), ("спул", self.spool), ("VFR", self.capture_mode == "vfr"),
+                 ("ротация файлов", bool(self.rotate_seconds or self.rotate_megabytes)),
+                 ("параллельное кодирование", self.encode_workers > 1)]
+        enabled = [name for name, on in modes if on]
+        return enabled[0] if enabled else None, enabled[1:]
+
+    def create_track_writer(self, track, fps, encoder_options):
+        target_size = track.target_size
+        if self.replay:
+            track.video_writer = ReplayBuffer(fps, target_size, self.replay_seconds,
+                                              self.replay_megabytes, self.replay_quality, self.video_format, encoder_options)
+        elif self.spool:
+            # Спул: кадры без кодирования на диск, видео - при перекодировании (SpoolTranscoder)
+            metadata = {"size": [track.width, track.height], "target_size": list(target_size), "fps": fps,
+                        "video_format": self.video_format, "base_filename": track.base_filename,
+                        "encoder_options": encoder_options, "interpolation": self.scale_interpolation,
+                        "compression": self.spool_compression, "chunk_seconds": self.spool_chunk_seconds,
+                        "audio_filename": self.audio_filename if self.audio_source and track is self.tracks[0] else ""}
+            track.video_writer = FrameSpool(track.base_filename + ".spool", metadata,
+                                            int(self.spool_megabytes * 1024 * 1024) // len(self.tracks))
+            track.output_filename = track.video_writer.filename
+        elif self.capture_mode == "vfr":
+            track.video_writer, track.output_filename = create_vfr_writer(
+                track.base_filename, self.video_format, fps, target_size, **encoder_options)
+        elif self.rotate_seconds or self.rotate_megabytes:
+            # Сегментированная запись: ротация файлов по времени или размеру с манифестом
+            track.video_writer = SegmentedWriter(track.base_filename, self.video_format, fps, target_size,
+                                                 int(fps * self.rotate_seconds), int(self.rotate_megabytes * 1024 * 1024),
+                                                 self.concat_segments, encoder_options)
+            track.output_filename = track.video_writer.manifest_filename
+        elif self.encode_workers > 1 and find_ffmpeg(self.ffmpeg_path):
+            # Многопроцессное кодирование: сегменты по segment_seconds кодируются параллельно
+            track.video_writer = SegmentEncoderPool(track.base_filename, self.video_format, fps, (track.width, track.height),
+                                                    self.encode_workers, fps * self.segment_seconds, self.queue_depth, encoder_options,
+                                                    target_size, self.scale_interpolation)
+            track.output_filename = track.base_filename
+        else:
+            track.video_writer, track.output_filename = create_video_writer(
+                track.base_filename, self.video_format, fps, target_size, **encoder_options)
+        return track.video_writer.isOpened()
+
+    def capture_from_source(self, source):
+        fps = self.fps
+        regions = self.resolve_regions(source)
+
+        # Все области снимаются одним захватом общего охватывающего прямоугольника,
+        # каждая запись получает свой срез этого кадра
+        left = min(region["left"] for region in regions)
+        top = min(region["top"] for region in regions)
+        right = max(region["left"] + region["width"] for region in regions)
+        bottom = max(region["top"] + region["height"] for region in regions)
+        monitor = {"left": left, "top": top, "width": right - left, "height": bottom - top}
+
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder, exist_ok=True)
+
+        base_filename = self.base_filename or os.path.join(self.output_folder, f"screen_record_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+        self.audio_filename = base_filename + ".wav"
+        encoder_options = {"preset": self.ffmpeg_preset, "crf": self.ffmpeg_crf,
+                           "threads": self.ffmpeg_threads, "ffmpeg_path": self.ffmpeg_path,
+                           "fragmented": self.fragmented_mp4}
+        self.tracks = []
+        for number, region in enumerate(regions, 1):
+            width_aligned = region["width"] - (region["width"] % 2)
+            height_aligned = region["height"] - (region["height"] % 2)
+            # Масштабирование выполняется один раз, на стороне кодирования, до конвертации цвета
+            target_size = output_size(width_aligned, height_aligned, self.output_scale, self.output_width, self.output_height)
+            suffix = f"_{number}" if len(regions) > 1 else ""
+            self.tracks.append(CaptureTrack(suffix.replace("_", "#"), (region["left"], region["top"]),
+                                            (region["left"] - left, region["top"] - top),
+                                            (width_aligned, height_aligned), target_size, base_filename + suffix))
+
+        mode, ignored = self.writer_conflicts()
+        if ignored:
+            print(f"Режим \"{mode}\" несовместим с: {', '.join(ignored)} - они отключены для этой записи.")
+        elif self.encode_workers > 1 and not find_ffmpeg(self.ffmpeg_path):
+            print("ffmpeg не найден: параллельное кодирование (encode_workers) отключено, запись одним кодировщиком.")
+
+        self.stats = PipelineStats()
+        for track in self.tracks:
+            if not self.create_track_writer(track, fps, encoder_options):
+                self.report_error(f"Не удалось инициализировать VideoWriter для формата {self.video_format}. Возможно, кодек не поддерживается.")
+                for opened in self.tracks:
+                    if opened.video_writer:
+                        opened.video_writer.release()
+                return
+
+        # Поток захвата только копирует кадры в кольца, конвертация и запись идут в отдельных потоках
+        for track in self.tracks:
+            if isinstance(track.video_writer, SegmentEncoderPool):
+                track.frame_ring = track.video_writer.create_ring(self.queue_policy)
+                encode_target = track.video_writer.dispatch_frames
+            elif isinstance(track.video_writer, FrameSpool):
+                track.frame_ring = FrameRing((track.height, track.width, 4), self.queue_depth, self.queue_policy)
+                encode_target = self.spool_frames
+                if self.spool_transcode == "background":
+                    self.transcoders.append(SpoolTranscoder(track.video_writer.filename).start())
+            else:
+                track.frame_ring = FrameRing((track.height, track.width, 4), self.queue_depth, self.queue_policy)
+                encode_target = self.encode_frames
+            # В VFR сравнение кадров включено всегда: неизменившиеся кадры не конвертируются
+            # и не передаются в ffmpeg, а только продлевают предыдущий (extend_last)
+            if self.change_detection or self.capture_mode == "vfr":
+                track.change_detector = ChangeDetector(self.change_tile_size, self.report_changed_tiles)
+            track.encode_thread = threading.Thread(target=encode_target, args=(track.frame_ring, track.video_writer, (track.width, track.height), track.target_size, track.name))
+            track.encode_thread.start()
+
+        self.cursor_overlay = None
+        if self.draw_cursor:
+            provider = create_cursor_provider(source)
+            if provider:
+                self.cursor_overlay = CursorOverlay(provider, self.cursor_scale, self.highlight_clicks)
+            else:
+                print("Положение курсора на этой платформе недоступно, запись без курсора.")
+
+        self.load_controller = self.create_load_controller(fps) if self.adaptive else None
+
+        interval = self.timelapse_interval if self.capture_mode == "timelapse" else None
+        self.frame_scheduler = FrameScheduler(fps, self.clock, interval)
+        self.frame_scheduler.start()
+        self.start_audio(base_filename)
+        self.snapshots_open = True
+
+        applied_region = None
+        while self.recording:
+            if self.paused:
+                if self.snapshot_requests:
+                    self.hand_off_snapshots()
+                time.sleep(0.01)
+                continue
+            self.frame_scheduler.wait_next_frame()
+            # Новое положение области (set_region) применяется только между кадрами;
+            # сравнение по идентичности кортежа не теряет обновления, пришедшие во время захвата
+            pending_region = self.pending_region
+            if pending_region is not applied_region and len(self.tracks) == 1:
+                applied_region = pending_region
+                monitor = self.move_region(source, monitor, pending_region)
+            if not self.recording:
+                break
+            if self.paused:
+                continue
+            if self.spool and any(track.video_writer.full for track in self.tracks):
+                print("Спул заполнен (лимит spool_megabytes), запись остановлена.")
+                break
+            try:
+                started = work_started = time.perf_counter()
+                frame = source.grab(monitor)
+                grabbed = time.perf_counter()
+                self.stats.add("grab", grabbed - started)
+                if self.first_frame_time is None:
+                    self.first_frame_time = grabbed
+                while self.snapshot_requests:
+                    callback, fallback = self.snapshot_requests.popleft()
+                    callback(frame.copy())
+                repeat = self.frame_scheduler.frames_due()
+                if repeat == 0:
+                    continue
+                cursor_state = self.cursor_overlay.sample() if self.cursor_overlay else None
+                for track in self.tracks:
+                    self.publish_track_frame(track, frame, repeat, cursor_state)
+                if self.load_controller:
+                    queue_fill = max(track.frame_ring.depth() for track in self.tracks) / self.queue_depth
+                    if self.load_controller.observe(time.perf_counter() - work_started, queue_fill):
+                        self.frame_scheduler.set_capture_fps(self.load_controller.capture_fps)
+            except mss.exception.ScreenShotError as e:
+                self.report_error(f"Ошибка захвата экрана: {e}. Возможно, область записи выходит за границы экрана.")
+                break
+            except Exception as e:
+                self.report_error(f"Произошла ошибка во время записи: {e}")
+                break
+
+        # Остановка, заполненный спул или ошибка: оставшиеся скриншоты снимаются отдельным захватом
+        self.hand_off_snapshots(close=True)
+        self.frame_scheduler.stop()
+        if self.audio_recorder:
+            self.audio_recorder.stop()
+        remaining = self.frame_scheduler.frames_remaining()
+        for track in self.tracks:
+            if remaining:
+                track.frame_ring.duplicate(remaining)
+            track.frame_ring.close()
+        for track in self.tracks:
+            track.encode_thread.join()
+            if track.frame_ring.dropped:
+                print(f"Пропущено кадров из-за переполнения очереди: {track.frame_ring.dropped}")
+        print(f"Статистика кадров: {self.frame_scheduler.stats()}")
+        if any(track.change_detector for track in self.tracks):
+            print(f"Кадров без изменений (без конвертации): {sum(track.change_detector.skipped_frames for track in self.tracks)}")
+            if self.report_changed_tiles:
+                print(f"Измененных плиток {self.change_tile_size}x{self.change_tile_size}: {sum(track.change_detector.changed_tiles_total for track in self.tracks)}")
+
+        for track in self.tracks:
+            track.video_writer.release()
+            # Пул и сегментированная запись узнают итоговое имя файла только после склейки
+            filename = getattr(track.video_writer, "filename", None)
+            if filename:
+                track.output_filename = filename
+            error = getattr(track.video_writer, "error", None)
+            if error:
+                # Файл пустой или оборван: не выдаем его за сохраненное видео
+                self.report_error(f"Ошибка кодирования видео {track.output_filename}: {error}")
+                track.output_filename = ""
+                continue
+            if isinstance(track.video_writer, FrameSpool):
+                print(f"Кадры сохранены в спул: {os.path.abspath(track.output_filename)}")
+                if self.spool_transcode != "background":
+                    self.transcoders.append(SpoolTranscoder(track.output_filename).start())
+            elif track.output_filename:
+                print(f"Видео сохранено в: {os.path.abspath(track.output_filename)}")
+        self.mux_audio()
+        if self.output_filename:
+            self.write_stats_log()
+
+    def create_load_controller(self, fps):
+        # Масштаб и пресет нельзя поменять внутри открытого видеопотока: их меняет только
+        # сегментированная запись (новый сегмент); для остальных режимов регулируется FPS захвата
+        reconfigurable = all(isinstance(track.video_writer, SegmentedWriter) for track in self.tracks)
+        if not reconfigurable:
+            print("Адаптация: масштаб и пресет регулируются только при записи с ротацией, используется FPS захвата.")
+        preset = None
+        if reconfigurable and VIDEO_FORMATS[self.video_format]["backend"] == "ffmpeg" and find_ffmpeg(self.ffmpeg_path):
+            preset = self.ffmpeg_preset
+        min_scale = self.output_scale
+        if reconfigurable and not (self.output_width or self.output_height):
+            min_scale = min(self.adaptive_min_scale, self.output_scale)
+        return LoadController(fps, self.adaptive_min_fps, self.output_scale, min_scale, preset, self.adaptive_fastest_preset)
+
+    def start_audio(self, base_filename):
+        # Звук пишется своим потоком и не трогает поток захвата кадров;
+        # ошибка звука не останавливает запись видео
+        if not self.audio_source or self.replay:
+            return
+        if self.capture_mode == "timelapse":
+            print("В режиме таймлапса звук не записывается.")
+            return
+        try:
+            source = create_audio_source(self.audio_source, self.audio_samplerate, self.audio_channels)
+            self.audio_recorder = AudioRecorder(source, self.audio_filename, self.clock.presentation_time)
+            self.audio_recorder.start()
+        except Exception as e:
+            print(f"Не удалось начать запись звука: {e}. Запись продолжается без звука.")
+            if self.audio_recorder and self.audio_recorder.wav:
+                self.audio_recorder.stop()
+            self.audio_recorder = None
+
+    def mux_audio(self):
+        # Сегментированная запись хранит манифест, а не видеофайл - звук для нее остается отдельным WAV.
+        # Спул сводит звук сам, после перекодирования
+        if not self.audio_recorder or self.spool:
+            return
+        targets = [track.output_filename for track in self.tracks
+                   if track.output_filename and not isinstance(track.video_writer, SegmentedWriter)]
+        muxed = [mux_audio(filename, self.audio_recorder.filename, self.ffmpeg_path) for filename in targets]
+        if muxed and all(muxed):
+            os.remove(self.audio_recorder.filename)
+        elif not muxed:
+            print(f"Звук сохранен в: {os.path.abspath(self.audio_recorder.filename)}")
+
+    def spool_frames(self, ring, spool, capture_size, target_size, name=""):
+        # Кадры из кольца копируются в спул как есть: масштабирование, конвертация цвета
+        # и кодирование откладываются до перекодирования
+        while True:
+            item = ring.get()
+            if item is None:
+                if ring.closed:
+                    break
+                continue
+            index, repeat = item
+            try:
+                started = time.perf_counter()
+                if index is not None:
+                    spool.append(ring.buffers[index], repeat)
+                else:
+                    spool.extend_last(repeat)
+                self.stats.add("spool" + name, time.perf_counter() - started)
+            except Exception as e:
+                print(f"Ошибка записи кадра в спул: {e}")
+            finally:
+                if index is not None:
+                    ring.release(index)
+
+    def wait_transcoding(self, timeout=None):
+        # Ждет перекодирования спулов (режим spool); в окне оно идет в фоне
+        for transcoder in self.transcoders:
+            transcoder.join(timeout)
+
+    def move_region(self, source, monitor, position):
+        # Область сдвигается в пределах всех мониторов, чтобы захват не упал за краем экрана
+        screen = source.monitors()[0]
+        left = min(max(position[0], screen["left"]), screen["left"] + screen["width"] - monitor["width"])
+        top = min(max(position[1], screen["top"]), screen["top"] + screen["height"] - monitor["height"])
+        track = self.tracks[0]
+        track.left, track.top = left, top
+        return {"left": left, "top": top, "width": monitor["width"], "height": monitor["height"]}
+
+    def publish_track_frame(self, track, frame, repeat, cursor_state=None):
+        started = time.perf_counter()
+        view = frame[track.y:track.y + track.height, track.x:track.x + track.width]
+        if track.change_detector:
+            # Сдвинувшийся курсор или идущая подсветка клика - тоже изменение кадра
+            changed = track.change_detector.is_changed(view) or cursor_state != track.cursor_state
+            track.cursor_state = cursor_state
+            detected = time.perf_counter()
+            self.stats.add("detect" + track.name, detected - started)
+            started = detected
+            if not changed:
+                track.frame_ring.duplicate(repeat)
+                return
+        index = track.frame_ring.acquire()
+        if index is None:
+            track.frame_ring.defer(repeat)
+            if track.change_detector:
+                track.change_detector.invalidate()
+            return
+        slot = track.frame_ring.buffers[index]
+        fit_frame(view, slot)
+        copied = time.perf_counter()
+        self.stats.add("copy" + track.name, copied - started)
+        if self.cursor_overlay:
+            # Курсор рисуется в собственную копию кадра в кольце, до масштабирования
+            self.cursor_overlay.draw(slot, track.left, track.top)
+            self.stats.add("cursor" + track.name, time.perf_counter() - copied)
+        track.frame_ring.publish(index, repeat)
+        self.stats.set_gauge("queue" + track.name, track.frame_ring.depth())
+
+    def encode_frames(self, ring, video_writer, capture_size, target_size, name=""):
+        # mss отдает BGRA, VideoWriter ждет BGR: масштабируем и конвертируем в одни и те же предвыделенные буферы
+        scaler = FrameScaler(capture_size, target_size, self.scale_interpolation)
+        img_bgr = np.empty((target_size[1], target_size[0], 3), dtype=np.uint8)
+        has_frame = False
+        version = 0
+
+        # Дописываем все опубликованные кадры, в том числе оставшиеся в очереди после остановки
+        while True:
+            item = ring.get()
+            if item is None:
+                if ring.closed:
+                    break
+                continue
+            index, repeat = item
+            try:
+                # Новый уровень LoadController применяется на границе кадра, с которого начнется новый сегмент
+                controller = self.load_controller
+                if controller and controller.version != version and index is not None and hasattr(video_writer, "reconfigure"):
+                    version = controller.version
+                    target_size = output_size(capture_size[0], capture_size[1], controller.scale, self.output_width, self.output_height)
+                    if target_size != scaler.target_size:
+                        scaler = FrameScaler(capture_size, target_size, self.scale_interpolation)
+                        img_bgr = np.empty((target_size[1], target_size[0], 3), dtype=np.uint8)
+                    video_writer.reconfigure(target_size, controller.preset)
+                # Для повтора (index None) конвертация не нужна: пишем прошлый кадр еще раз
+                started = time.perf_counter()
+                if index is not None:
+                    scaled = scaler.scale(ring.buffers[index])
+                    if not scaler.identity:
+                        self.stats.add("scale" + name, time.perf_counter() - started)
+                    started = time.perf_counter()
+                    cv2.cvtColor(scaled, cv2.COLOR_BGRA2BGR, dst=img_bgr)
+                    has_frame = True
+                converted = time.perf_counter()
+                self.stats.add("convert" + name, converted - started)
+
+                if has_frame and hasattr(video_writer, "extend_last"):
+                    if index is not None:
+                        video_writer.write(img_bgr)
+                        repeat -= 1
+                    if repeat:
+                        video_writer.extend_last(repeat)
+                elif has_frame:
+                    for _ in range(repeat):
+                        video_writer.write(img_bgr)
+                self.stats.add("write" + name, time.perf_counter() - converted)
+            except Exception as e:
+                print(f"Ошибка кодирования кадра: {e}")
+            finally:
+                if index is not None:
+                    ring.release(index)
+
+
 
 class ScreenRecorder:
+    # Обновление рамок при перетаскивании - не чаще раза в кадр экрана (~60 Гц)
+    OVERLAY_UPDATE_MS = 16
+    # Период разбора событий фоновых потоков (конец записи, ошибки, готовые скриншоты)
+    ENGINE_POLL_MS = 100
+
     def __init__(self, master):
         self.master = master
         
@@ -25,6 +2833,12 @@ class ScreenRecorder:
         self.fps = 60
         self.output_folder = os.getcwd()
         self.video_format = ".wmv"
+        self.engine_options = dict(ENGINE_DEFAULTS)
+        self.screenshot_format = "jpg"
+        self.screenshot_quality = 95
+        self.png_compression = 3
+        self.burst_count = 5
+        self.burst_interval_ms = 200
         self.window_width = 750
         self.window_height = 50
         self.window_x = None
@@ -56,24 +2870,35 @@ class ScreenRecorder:
         self.recording = False
         self.paused = False
         self.output_filename = "" 
-        self.video_writer = None
-        self.record_thread = None
+        self.engine = None
+        self.replay_engine = None
+        self.screenshot_worker = ScreenshotWorker()
+        self.spool_transcoders = []
+        self.startup_timing = {"started": datetime.now().isoformat(timespec="seconds")}
+        self.startup_logged = False
 
         self.record_x = 0
         self.record_y = 0
         
-        self.start_time = None
-        self.pause_start_time = None
-        self.elapsed_time_on_pause = timedelta(seconds=0)
         self.timer_id = None
+        self.stats_id = None
+        # События из фоновых потоков: они не трогают Tk сами (вызов Tk из другого потока ждет
+        # главный цикл и зависает, пока тот ждет остановки записи), главный цикл забирает их по таймеру
+        self.engine_events = queue.Queue()
         
         self.frames = []
         
         self.frame_thickness = 10
+        # Кэш положения рамок: Tk опрашивается только при движении главного окна
+        self.frame_geometry = [None] * 4
+        self.title_size = None
+        self.overlay_update_id = None
+        self.follow_main_window = False
         
         self.resize_mode = None 
         self.start_x = 0
         self.start_y = 0
+        self.press_y_root = 0
         self.initial_width = self.record_width
         self.initial_height = self.record_height
         
@@ -85,17 +2910,75 @@ class ScreenRecorder:
         self.video_format_var = tk.StringVar(self.master)
         self.video_format_var.set(self.video_format)
         self.video_format_var.trace('w', self.save_format_setting)
+
+        # Выбор монитора для режима "Весь экран": номер, все мониторы одной картинкой или каждый в свой файл.
+        # Пока mss не загружен, в списке только сохраненный монитор; полный список - после warm_up
+        selected = self.engine_options["monitor"]
+        self.monitor_choices = self.build_monitor_choices(max(selected, 1) + 1 if isinstance(selected, int) else 2)
+        monitor_names = {value: name for name, value in self.monitor_choices.items()}
+        self.monitor_var = tk.StringVar(self.master)
+        self.monitor_var.set(monitor_names.get(selected, "Монитор 1"))
+        self.monitor_var.trace('w', self.save_monitor_setting)
+
+        # Режим записи: обычный, таймлапс (кадр раз в timelapse_interval секунд) или VFR (только изменившиеся кадры)
+        if self.engine_options["capture_mode"] not in CAPTURE_MODES:
+            self.engine_options["capture_mode"] = "normal"
+        mode_names = {value: name for name, value in CAPTURE_MODE_NAMES.items()}
+        self.capture_mode_var = tk.StringVar(self.master)
+        self.capture_mode_var.set(mode_names[self.engine_options["capture_mode"]])
+        self.capture_mode_var.trace('w', self.save_capture_mode_setting)
         
         self.create_widgets()
         
         self.default_start_button_bg = self.start_button.cget('bg')
-        
+
+        self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.master.after(self.ENGINE_POLL_MS, self.poll_engine_events)
+
+        # Сначала показывается панель: рамки создаются, когда Tk отрисует окно,
+        # а cv2, numpy и mss тем временем импортируются в фоне
+        self.master.after_idle(self.finish_startup)
+        warm_up(lambda monitors: self.call_from_engine(self.on_warm_up_done, monitors))
+
+    def build_monitor_choices(self, monitor_count):
+        # monitor_count - длина списка mss.monitors: [все мониторы, монитор 1, монитор 2, ...]
+        choices = {f"Монитор {index}": index for index in range(1, monitor_count)}
+        choices["Все мониторы"] = 0
+        choices["Каждый отдельно"] = "each"
+        return choices
+
+    def finish_startup(self):
+        self.master.update_idletasks()
+        self.startup_timing["window_seconds"] = round(time.perf_counter() - STARTUP_TIME, 3)
+        print(f"Окно показано через {self.startup_timing['window_seconds']:.2f} с после запуска")
+
         self.create_frames()
         self.master.bind("<Configure>", self.on_main_window_move)
-        
         self.update_window_title()
+        # Спулы, которые не успели перекодироваться до закрытия программы, доделываются в фоне
+        self.spool_transcoders = resume_spools(self.output_folder)
 
-        self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
+    def on_warm_up_done(self, monitors):
+        self.startup_timing["imports_seconds"] = round(time.perf_counter() - STARTUP_TIME, 3)
+        print(f"Модули записи загружены через {self.startup_timing['imports_seconds']:.2f} с после запуска")
+        if not monitors:
+            return
+        self.monitor_choices = self.build_monitor_choices(len(monitors))
+        menu = self.monitor_menu["menu"]
+        menu.delete(0, "end")
+        for name in self.monitor_choices:
+            menu.add_command(label=name, command=tk._setit(self.monitor_var, name))
+
+    def log_startup_timing(self):
+        # Одна строка JSON на запуск в startup_timing.jsonl рядом с settings.json
+        if self.startup_logged:
+            return
+        self.startup_logged = True
+        try:
+            with open("startup_timing.jsonl", "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.startup_timing, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Не удалось сохранить время запуска: {e}")
 
     def create_widgets(self):
         button_frame = tk.Frame(self.master)
@@ -110,8 +2993,18 @@ class ScreenRecorder:
         self.stop_button = tk.Button(button_frame, text="⏹️", font=("Segoe UI Symbol", 14), command=self.stop_recording, state=tk.DISABLED)
         self.stop_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        # Левая кнопка - один снимок, правая - серия из burst_count снимков
         self.screenshot_button = tk.Button(button_frame, text="📷", font=("Segoe UI Symbol", 14), command=self.take_screenshot)
         self.screenshot_button.pack(side=tk.LEFT, padx=5, pady=5)
+        self.screenshot_button.bind("<Button-3>", self.take_burst)
+
+        # Буфер повтора: ⏪ включает/выключает фоновый захват, 💾 (или F9) сохраняет последние секунды
+        self.replay_button = tk.Button(button_frame, text="⏪", font=("Segoe UI Symbol", 14), command=self.toggle_replay_buffer)
+        self.replay_button.pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.save_replay_button = tk.Button(button_frame, text="💾", font=("Segoe UI Symbol", 14), command=self.save_replay, state=tk.DISABLED)
+        self.save_replay_button.pack(side=tk.LEFT, padx=5, pady=5)
+        self.master.bind_all("<F9>", lambda event: self.save_replay())
 
         self.open_folder_button = tk.Button(button_frame, text="📁", font=("Segoe UI Symbol", 14))
         self.open_folder_button.pack(side=tk.LEFT, padx=5, pady=5)
@@ -121,7 +3014,7 @@ class ScreenRecorder:
         format_label = tk.Label(button_frame, text="Формат:", font=("Segoe UI", 12))
         format_label.pack(side=tk.LEFT, padx=(10, 0), pady=5)
 
-        formats = [".wmv", ".mp4"]
+        formats = list(VIDEO_FORMATS)
         format_menu = tk.OptionMenu(button_frame, self.video_format_var, *formats)
         format_menu.config(font=("Segoe UI", 12))
         format_menu.pack(side=tk.LEFT, padx=5, pady=5)
@@ -134,6 +3027,10 @@ class ScreenRecorder:
 
         self.timer_label = tk.Label(button_frame, text="00:00:00", font=("Segoe UI", 14), fg="red")
         self.timer_label.pack(side=tk.RIGHT, padx=5, pady=5)
+
+        # Живая статистика записи: фактический/целевой FPS, потерянные кадры, очередь, самый медленный этап
+        self.stats_label = tk.Label(button_frame, text="", font=("Segoe UI", 9), fg="gray")
+        self.stats_label.pack(side=tk.RIGHT, padx=5, pady=5)
         
         self.capture_mode_switch = tk.Checkbutton(
             button_frame,
@@ -142,11 +3039,29 @@ class ScreenRecorder:
             command=self.toggle_capture_mode
         )
         self.capture_mode_switch.pack(side=tk.RIGHT, padx=5, pady=5)
+
+        self.monitor_menu = tk.OptionMenu(button_frame, self.monitor_var, *self.monitor_choices)
+        self.monitor_menu.config(font=("Segoe UI", 9))
+        self.monitor_menu.pack(side=tk.RIGHT, pady=5)
+
+        self.capture_mode_menu = tk.OptionMenu(button_frame, self.capture_mode_var, *CAPTURE_MODE_NAMES)
+        self.capture_mode_menu.config(font=("Segoe UI", 9))
+        self.capture_mode_menu.pack(side=tk.RIGHT, padx=5, pady=5)
         
     def save_format_setting(self, *args):
         self.video_format = self.video_format_var.get()
         self.save_settings()
 
+    def save_capture_mode_setting(self, *args):
+        self.engine_options["capture_mode"] = CAPTURE_MODE_NAMES.get(self.capture_mode_var.get(), "normal")
+        self.save_settings()
+
+    def save_monitor_setting(self, *args):
+        self.engine_options["monitor"] = self.monitor_choices.get(self.monitor_var.get(), 1)
+        if self.is_full_screen_mode.get():
+            self.toggle_capture_mode()
+        self.save_settings()
+
     def create_frames(self):
         if not self.frames:
             for i in range(4):
@@ -181,7 +3096,9 @@ class ScreenRecorder:
         else:
             self.hide_frames()
 
-    # Функции для перетаскивания рамок
+    # Функции для перетаскивания рамок. События мыши только меняют закэшированную область
+    # (record_x/record_y/record_width/record_height), а рамки, заголовок и область записи
+    # обновляются одним вызовом schedule_overlay_update не чаще раза в кадр экрана
     def on_frame_drag_start(self, event):
         self.drag_x = event.x_root
         self.drag_y = event.y_root
@@ -195,48 +3112,65 @@ class ScreenRecorder:
 
     def on_frame_drag(self, event):
         if self.is_dragging and not self.resize_mode:
-            delta_x = event.x_root - self.drag_x
-            delta_y = event.y_root - self.drag_y
-
-            for frame in self.frames:
-                new_x = frame.winfo_x() + delta_x
-                new_y = frame.winfo_y() + delta_y
-                frame.geometry(f"+{new_x}+{new_y}")
-
+            self.record_x += event.x_root - self.drag_x
+            self.record_y += event.y_root - self.drag_y
             self.drag_x = event.x_root
             self.drag_y = event.y_root
-            self.update_capture_area()
-            self.update_window_title()
+            self.schedule_overlay_update()
         
         elif self.resize_mode:
             if self.resize_mode == 'width':
-                left_capture_area_x = self.frames[2].winfo_x() + self.frame_thickness
-                new_record_width = event.x_root - left_capture_area_x
-
+                new_record_width = event.x_root - self.record_x
                 if new_record_width > 50:
                     self.record_width = new_record_width
-                    self.on_main_window_move(None)
-                    self.update_window_title()
+                    self.schedule_overlay_update()
 
             elif self.resize_mode == 'height':
-                new_height = self.initial_height + (event.y_root - self.frames[1].winfo_y())
+                new_height = self.initial_height + (event.y_root - self.press_y_root)
                 if new_height > 50:
                     self.record_height = new_height
-                    self.on_main_window_move(None)
-                    self.update_window_title()
+                    self.schedule_overlay_update()
 
 
     def on_frame_drag_end(self, event):
         self.is_dragging = False
 
-    def update_capture_area(self):
+    def schedule_overlay_update(self):
+        if self.overlay_update_id is None:
+            self.overlay_update_id = self.master.after(self.OVERLAY_UPDATE_MS, self.apply_overlay_update)
+
+    def overlay_geometry(self):
+        t = self.frame_thickness
+        x, y, width, height = self.record_x, self.record_y, self.record_width, self.record_height
+        return [f"{width + t * 2}x{t}+{x - t}+{y - t}",
+                f"{width + t * 2}x{t}+{x - t}+{y + height}",
+                f"{t}x{height}+{x - t}+{y}",
+                f"{t}x{height}+{x + width}+{y}"]
+
+    def apply_overlay_update(self):
+        self.overlay_update_id = None
         if not self.frames:
             return
-        
-        self.record_x = self.frames[2].winfo_x() + self.frame_thickness
-        self.record_y = self.frames[0].winfo_y() + self.frame_thickness
-        self.record_width = self.frames[0].winfo_width() - self.frame_thickness * 2
-        self.record_height = self.frames[2].winfo_height()
+        if self.follow_main_window:
+            self.follow_main_window = False
+            self.place_under_main_window()
+        # geometry() вызывается только для рамок, которые действительно сдвинулись
+        for index, geometry in enumerate(self.overlay_geometry()):
+            if geometry != self.frame_geometry[index]:
+                self.frames[index].geometry(geometry)
+                self.frame_geometry[index] = geometry
+        if (self.record_width, self.record_height) != self.title_size:
+            self.update_window_title()
+        self.update_capture_area()
+
+    def update_capture_area(self):
+        # Движок переносит область захвата сам, на границе кадра; размер записи не меняется
+        if self.is_full_screen_mode.get():
+            return
+        region = {"left": self.record_x, "top": self.record_y, "width": self.record_width, "height": self.record_height}
+        for engine in (self.engine, self.replay_engine):
+            if engine and engine.recording:
+                engine.set_region(region)
 
     def close_capture_frames(self):
         self.is_full_screen_mode.set(True)
@@ -257,7 +3191,8 @@ class ScreenRecorder:
             self.capture_mode_switch.config(text="Область")
             
             with mss.mss() as sct:
-                monitor = sct.monitors[1]
+                selected = self.engine_options["monitor"]
+                monitor = sct.monitors[selected if isinstance(selected, int) and selected < len(sct.monitors) else 1]
                 self.record_x = monitor['left']
                 self.record_y = monitor['top']
                 self.record_width = monitor['width']
@@ -280,11 +3215,10 @@ class ScreenRecorder:
         
         try:
             if self.is_full_screen_mode.get():
-                self.master.title(f"📸 Запись экрана (Захват: ВЕСЬ ЭКРАН)")
+                self.master.title(f"📸 Запись экрана (Захват: ВЕСЬ ЭКРАН, {self.monitor_var.get()})")
             else:
-                width = self.frames[0].winfo_width() - self.frame_thickness * 2
-                height = self.frames[2].winfo_height()
-                self.master.title(f"📸 Запись экрана (Размер захвата: {width}x{height} px)")
+                self.title_size = (self.record_width, self.record_height)
+                self.master.title(f"📸 Запись экрана (Размер захвата: {self.record_width}x{self.record_height} px)")
         except tk.TclError:
             self.master.title(f"📸 Запись экрана")
 
@@ -292,6 +3226,7 @@ class ScreenRecorder:
         self.resize_mode = mode
         self.start_x = event.x
         self.start_y = event.y
+        self.press_y_root = event.y_root
         self.initial_width = self.record_width
         self.initial_height = self.record_height
 
@@ -299,27 +3234,24 @@ class ScreenRecorder:
         self.resize_mode = None
 
     def on_main_window_move(self, event):
+        # <Configure> корня приходит и от всех дочерних виджетов - нужен только сам корень
         if self.is_full_screen_mode.get() or not self.frames:
             return
-        
+        if event is not None and event.widget is not self.master:
+            return
+        # Положение окна читается один раз при обновлении рамок, а не на каждое событие
+        self.follow_main_window = True
+        self.schedule_overlay_update()
+
+    def place_under_main_window(self):
         x, y = self.master.winfo_x(), self.master.winfo_y()
-        main_width, main_height = self.master.winfo_width(), self.master.winfo_height()
+        main_height = self.master.winfo_height()
         
         offset_y = y + main_height + 40 
         offset_x = 10
         
-        horizontal_width = self.record_width + self.frame_thickness * 2
-        vertical_height = self.record_height
-        
-        # Обновление размеров и позиции рамок с учетом новой толщины
-        self.frames[0].geometry(f"{horizontal_width}x{self.frame_thickness}+{x - self.frame_thickness + offset_x}+{offset_y}")
-        self.frames[1].geometry(f"{horizontal_width}x{self.frame_thickness}+{x - self.frame_thickness + offset_x}+{offset_y + vertical_height + self.frame_thickness}")
-        self.frames[2].geometry(f"{self.frame_thickness}x{vertical_height}+{x - self.frame_thickness + offset_x}+{offset_y + self.frame_thickness}")
-        self.frames[3].geometry(f"{self.frame_thickness}x{vertical_height}+{x + self.record_width + offset_x}+{offset_y + self.frame_thickness}")
-        
-        self.update_capture_area()
-
-        self.update_window_title()
+        self.record_x = x + offset_x
+        self.record_y = offset_y + self.frame_thickness
 
     def load_settings(self):
         try:
@@ -330,6 +3262,17 @@ class ScreenRecorder:
                 self.fps = settings.get("fps", self.fps)
                 self.output_folder = settings.get("output_folder", self.output_folder)
                 self.video_format = settings.get("video_format", self.video_format)
+                if self.video_format not in VIDEO_FORMATS:
+                    self.video_format = ".wmv"
+                for key in self.engine_options:
+                    self.engine_options[key] = settings.get(key, self.engine_options[key])
+                self.screenshot_format = settings.get("screenshot_format", self.screenshot_format)
+                if self.screenshot_format not in SCREENSHOT_FORMATS:
+                    self.screenshot_format = "jpg"
+                self.screenshot_quality = settings.get("screenshot_quality", self.screenshot_quality)
+                self.png_compression = settings.get("png_compression", self.png_compression)
+                self.burst_count = settings.get("burst_count", self.burst_count)
+                self.burst_interval_ms = settings.get("burst_interval_ms", self.burst_interval_ms)
                 self.window_x = settings.get("window_x", None)
                 self.window_y = settings.get("window_y", None)
                 self.window_width = settings.get("window_width", self.window_width)
@@ -351,12 +3294,18 @@ class ScreenRecorder:
             "fps": fps_value,
             "output_folder": self.output_folder,
             "video_format": self.video_format,
+            "screenshot_format": self.screenshot_format,
+            "screenshot_quality": self.screenshot_quality,
+            "png_compression": self.png_compression,
+            "burst_count": self.burst_count,
+            "burst_interval_ms": self.burst_interval_ms,
             "window_x": self.master.winfo_x(),
             "window_y": self.master.winfo_y(),
             "window_width": self.master.winfo_width(),
             "window_height": self.master.winfo_height(),
             "is_full_screen_mode": self.is_full_screen_mode.get()
         }
+        settings.update(self.engine_options)
         
         try:
             with open("settings.json", "w") as f:
@@ -371,7 +3320,10 @@ class ScreenRecorder:
             self.record_height = 340
 
         self.stop_recording()
+        self.stop_replay_buffer()
+        self.screenshot_worker.stop()
         self.save_settings()
+        self.log_startup_timing()
         self.master.destroy()
         
     def ask_output_folder(self, event=None):
@@ -400,80 +3352,35 @@ class ScreenRecorder:
             messagebox.showerror("Ошибка", f"Не удалось открыть папку: {e}")
 
     def update_timer(self):
-        if self.recording and not self.paused and self.start_time:
-            current_elapsed_time = (datetime.now() - self.start_time) - self.elapsed_time_on_pause
-            
-            total_seconds = int(current_elapsed_time.total_seconds())
+        # Таймер показывает время часов записи движка - ровно то, что попадает в файл
+        if self.recording and self.engine:
+            total_seconds = int(self.engine.elapsed())
             hours = total_seconds // 3600
             minutes = (total_seconds % 3600) // 60
             seconds = total_seconds % 60
             
             time_str = f"{hours:02}:{minutes:02}:{seconds:02}"
+            if self.engine.capture_mode == "timelapse":
+                # В таймлапсе рядом показываем, сколько секунд уже набралось в итоговом видео
+                time_str += f" → {self.engine.output_seconds():.1f} с"
             self.timer_label.config(text=time_str)
         
-        self.timer_id = self.master.after(1000, self.update_timer)
-
-    def record_screen(self):
-        try:
-            fps = int(self.fps_entry.get())
-            if fps <= 0:
-                fps = 30
-        except (ValueError, IndexError):
-            fps = 30
-        
-        sct = mss.mss()
-        
-        if self.is_full_screen_mode.get():
-            monitor = sct.monitors[1]
-        else:
-            monitor = {"top": self.record_y, "left": self.record_x,
-                       "width": self.record_width, "height": self.record_height}
-
-        if self.video_format == ".mp4":
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v') 
-            extension = ".mp4"
-        else:
-            fourcc = cv2.VideoWriter_fourcc(*'WMV2')
-            extension = ".wmv"
-
-        width_aligned = monitor["width"] - (monitor["width"] % 2)
-        height_aligned = monitor["height"] - (monitor["height"] % 2)
-
-        if not os.path.exists(self.output_folder):
-            os.makedirs(self.output_folder, exist_ok=True)
-            
-        self.output_filename = os.path.join(self.output_folder, f"screen_record_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}{extension}")
-        self.video_writer = cv2.VideoWriter(self.output_filename, fourcc, fps, (width_aligned, height_aligned))
-
-        if not self.video_writer.isOpened():
-            messagebox.showerror("Ошибка", f"Не удалось инициализировать VideoWriter для формата {extension}. Возможно, кодек не поддерживается.")
-            self.stop_recording()
-            return
-
-        while self.recording:
-            if not self.paused:
-                try:
-                    sct_img = sct.grab(monitor)
-                    img = np.array(sct_img)
-                    img_rgb = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-
-                    if img_rgb.shape[1] != width_aligned or img_rgb.shape[0] != height_aligned:
-                        img_rgb = cv2.resize(img_rgb, (width_aligned, height_aligned))
-
-                    self.video_writer.write(img_rgb)
-                except mss.exception.ScreenShotError as e:
-                    print(f"Ошибка захвата экрана: {e}. Возможно, область записи выходит за границы экрана.")
-                    self.stop_recording()
-                    break
-                except Exception as e:
-                    print(f"Произошла ошибка во время записи: {e}")
-                    self.stop_recording()
-                    break
-            time.sleep(1 / fps)
-
-        if self.video_writer:
-            self.video_writer.release()
-        print(f"Видео сохранено в: {os.path.abspath(self.output_filename)}")
+        self.timer_id = self.master.after(200, self.update_timer)
+
+    def update_stats_label(self):
+        if self.engine and "first_frame_seconds" not in self.startup_timing and self.engine.first_frame_time:
+            self.startup_timing["first_frame_seconds"] = self.engine.first_frame_seconds()
+            print(f"Первый кадр записи через {self.startup_timing['first_frame_seconds']:.2f} с после нажатия")
+            self.log_startup_timing()
+        stats = self.engine.live_stats() if self.engine else None
+        if stats and not self.paused:
+            digits = 0 if stats["target_fps"] >= 1 else 2
+            text = f"{stats['fps']:.{digits}f}/{stats['target_fps']:.{digits}f} к/с  потери {stats['dropped']}  очередь {stats['queue']}"
+            if stats["slowest_stage"]:
+                stage, p90 = stats["slowest_stage"]
+                text += f"  {stage} {p90:.1f} мс"
+            self.stats_label.config(text=text, fg="red" if stats["fps"] < stats["target_fps"] * 0.9 else "gray")
+        self.stats_id = self.master.after(500, self.update_stats_label)
 
     def start_recording(self):
         if self.recording:
@@ -482,34 +3389,97 @@ class ScreenRecorder:
         self.recording = True
         self.paused = False
         
-        self.start_time = datetime.now()
-        self.pause_start_time = None
-        self.elapsed_time_on_pause = timedelta(seconds=0)
         self.timer_label.config(text="00:00:00") 
-        self.update_timer()
 
         self.start_button.config(state=tk.DISABLED, bg="red")
         self.pause_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.NORMAL)
-        self.screenshot_button.config(state=tk.DISABLED) 
 
-        self.record_thread = threading.Thread(target=self.record_screen)
-        self.record_thread.start()
+        self.engine = self.create_engine()
+        self.engine.start()
+        self.update_timer()
+        self.update_stats_label()
+
+    def toggle_replay_buffer(self):
+        if self.replay_engine:
+            self.stop_replay_buffer()
+            return
+        self.replay_engine = self.create_engine(replay=True)
+        engine = self.replay_engine
+        engine.on_finished = lambda: self.call_from_engine(self.on_replay_finished, engine)
+        self.replay_engine.start()
+        self.replay_button.config(bg="orange")
+        self.save_replay_button.config(state=tk.NORMAL)
+
+    def on_replay_finished(self, engine):
+        # Буфер повтора остановился сам (ошибка); событие от прошлого движка игнорируем
+        if engine is self.replay_engine:
+            self.stop_replay_buffer()
+
+    def stop_replay_buffer(self):
+        if not self.replay_engine:
+            return
+        engine, self.replay_engine = self.replay_engine, None
+        engine.stop(timeout=5)
+        self.replay_button.config(bg=self.default_start_button_bg)
+        self.save_replay_button.config(state=tk.DISABLED)
+
+    def save_replay(self):
+        if not self.replay_engine:
+            return
+        self.save_replay_button.config(fg="green")
+        self.replay_engine.flush_replay(on_done=lambda filename: self.call_from_engine(self.save_replay_button.config, {"fg": "black"}))
+
+    def create_engine(self, replay=False):
+        try:
+            fps = int(self.fps_entry.get())
+            if fps <= 0:
+                fps = 30
+        except (ValueError, IndexError):
+            fps = 30
+
+        if self.is_full_screen_mode.get():
+            region = None
+        else:
+            region = {"top": self.record_y, "left": self.record_x,
+                      "width": self.record_width, "height": self.record_height}
+
+        engine = RecordingEngine(region, fps, self.output_folder, self.video_format, replay=replay, **self.engine_options)
+        engine.on_error = lambda message: self.call_from_engine(messagebox.showerror, "Ошибка", message)
+        engine.on_finished = lambda: self.call_from_engine(self.on_engine_finished, engine)
+        return engine
+
+    def on_engine_finished(self, engine):
+        # Запись остановилась сама (ошибка, спул заполнен); событие от прошлого движка игнорируем
+        if engine is self.engine:
+            self.stop_recording()
+
+    def call_from_engine(self, callback, *args):
+        # Колбэки движка приходят из потока записи: кладем их в очередь, главный цикл Tk
+        # выполнит их в poll_engine_events
+        self.engine_events.put((callback, args))
+
+    def poll_engine_events(self):
+        while True:
+            try:
+                callback, args = self.engine_events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Ошибка обработки события записи: {e}")
+        self.master.after(self.ENGINE_POLL_MS, self.poll_engine_events)
 
     def pause_recording(self):
         if self.recording:
             self.paused = not self.paused
             if self.paused:
+                self.engine.pause()
                 self.pause_button.config(text="▶️")
-                if self.timer_id:
-                    self.master.after_cancel(self.timer_id)
-                self.pause_start_time = datetime.now() 
             else:
+                self.engine.resume()
                 self.pause_button.config(text="⏸️")
-                if self.pause_start_time:
-                    self.elapsed_time_on_pause += (datetime.now() - self.pause_start_time)
-                self.pause_start_time = None
-                self.update_timer()
 
     def stop_recording(self):
         if not self.recording:
@@ -519,57 +3489,321 @@ class ScreenRecorder:
         if self.timer_id:
             self.master.after_cancel(self.timer_id)
         self.timer_label.config(text="00:00:00")
+        if self.stats_id:
+            self.master.after_cancel(self.stats_id)
+            self.stats_id = None
+        self.stats_label.config(text="")
 
-        if self.record_thread and self.record_thread.is_alive():
-            self.record_thread.join(timeout=5)
-            if self.record_thread.is_alive():
+        if self.engine:
+            if not self.engine.stop(timeout=5):
                 print("Предупреждение: Поток записи не завершился вовремя.")
+            self.output_filename = self.engine.output_filename
 
         self.start_button.config(state=tk.NORMAL, bg=self.default_start_button_bg)
         self.pause_button.config(state=tk.DISABLED, text="⏸️")
         self.stop_button.config(state=tk.DISABLED)
-        self.screenshot_button.config(state=tk.NORMAL) 
         
-        print(f"Видео сохранено в: {os.path.abspath(self.output_filename)}")
+        # При ошибке кодирования движок не отдает имя файла - сообщение об ошибке уже показано
+        if self.output_filename:
+            print(f"Видео сохранено в: {os.path.abspath(self.output_filename)}")
+
+    def take_screenshot(self, event=None):
+        # Захват идет сразу в фоновом потоке захвата, кодирование - в потоке кодирования.
+        # Во время записи кадр берется из конвейера записи, без второго захвата экрана.
+        job = {
+            "output_folder": self.output_folder,
+            "taken": datetime.now(),
+            "image_format": self.screenshot_format,
+            "quality": self.screenshot_quality,
+            "png_compression": self.png_compression,
+            "on_done": lambda filename: self.call_from_engine(self.on_screenshot_saved, filename),
+            "on_error": lambda error: self.call_from_engine(self.on_screenshot_error, error),
+        }
+        if self.is_full_screen_mode.get():
+            # Монитор из меню рядом с "Весь экран", как и для записи
+            job["monitor"] = self.engine_options["monitor"]
+        else:
+            job["region"] = {"top": self.record_y, "left": self.record_x,
+                             "width": self.record_width, "height": self.record_height}
+        if self.recording and not self.paused and self.engine:
+            # Если кадр записи не успеет (таймлапс, остановка), движок вернет задание обычным захватом
+            self.engine.request_snapshot(lambda frame: self.screenshot_worker.submit(dict(job, frame=frame)),
+                                         lambda: self.screenshot_worker.submit(job))
+            return
+        self.screenshot_worker.submit(job)
+
+    def take_burst(self, event=None):
+        for shot in range(self.burst_count):
+            self.master.after(shot * self.burst_interval_ms, self.take_screenshot)
+
+    def on_screenshot_saved(self, filename):
+        self.screenshot_button.config(text="✅") 
+        self.master.after(1000, lambda: self.screenshot_button.config(text="📷")) 
+
+        print(f"Скриншот сохранен в: {os.path.abspath(filename)}")
+
+    def on_screenshot_error(self, error):
+        messagebox.showerror("Ошибка", f"Не удалось сделать скриншот: {error}")
+        print(f"Ошибка скриншота: {error}")
+
+def parse_region(text):
+    try:
+        x, y, width, height = (int(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("область задается как x,y,w,h")
+    return {"left": x, "top": y, "width": width, "height": height}
+
+
+def parse_monitor(text):
+    if text == "each":
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("монитор задается номером (0 - все мониторы) или each")
+
+
+def format_for_extension(extension):
+    for name, spec in VIDEO_FORMATS.items():
+        if spec["extension"] == extension.lower():
+            return name
+    return ".wmv"
+
+
+def cli_record(args):
+    options = load_engine_options()
+    if args.workers is not None:
+        options["encode_workers"] = args.workers
+    if args.scale is not None:
+        options["output_scale"] = args.scale
+    if args.audio is not None:
+        options["audio_source"] = args.audio
+    if args.cursor:
+        options["draw_cursor"] = True
+    if args.spool:
+        options["spool"] = True
+    if args.timelapse:
+        options["capture_mode"] = "timelapse"
+        options["timelapse_interval"] = args.timelapse
+    elif args.vfr:
+        options["capture_mode"] = "vfr"
+
+    output_folder = os.getcwd()
+    base_filename = None
+    video_format = args.format
+    if args.out:
+        root, extension = os.path.splitext(args.out)
+        if extension:
+            base_filename = root
+            video_format = video_format or format_for_extension(extension)
+            output_folder = os.path.dirname(os.path.abspath(args.out))
+        else:
+            output_folder = args.out
+
+    # Несколько --region/--monitor записываются одновременно, каждый в свой файл
+    regions = (args.region or []) + [monitor for monitor in (args.monitor or []) if monitor != "each"]
+    if "each" in (args.monitor or []) and not regions:
+        options["monitor"] = "each"
+    region = regions[0] if len(regions) == 1 else regions or None
+    monitor_count = max([monitor for monitor in args.monitor or [] if isinstance(monitor, int)] + [1])
+    source = create_source(args.source, region, args.change_rate, monitor_count)
+    engine = RecordingEngine(region, args.fps, output_folder, video_format or ".wmv", base_filename, source, **options)
+    engine.start()
+    started = time.monotonic()
+    try:
+        while engine.recording:
+            if args.duration and time.monotonic() - started >= args.duration:
+                break
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    engine.stop()
+    engine.wait_transcoding()
+    return 1 if engine.error else 0
+
+
+def cli_transcode(args):
+    for filename in args.spools:
+        SpoolTranscoder(filename, resume=True).start().join()
+    return 0
+
+
+def peak_rss_bytes():
+    # Пиковый объем памяти процесса за все время работы или None, если его не узнать
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def cpu_seconds():
+    # Процессорное время процесса и завершенных дочерних процессов (пул кодирования)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def bench_case(width, height, video_format, fps, duration, change_rate, options, folder):
+    region = {"left": 0, "top": 0, "width": width, "height": height}
+    source = SyntheticSource(width, height, change_rate)
+    engine = RecordingEngine(region, fps, folder, video_format, None, source, **options)
+
+    cpu_started = cpu_seconds()
+    started = time.monotonic()
+    engine.start()
+    while engine.recording and time.monotonic() - started < duration:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    engine.stop()
+    cpu_used = cpu_seconds() - cpu_started
+    # Без ffmpeg ffmpeg-форматы пишутся через OpenCV: в отчет идет то, чем кодировали на самом деле
+    used_format = effective_video_format(video_format, options["ffmpeg_path"])
+    spec = VIDEO_FORMATS[used_format]
+
+    output_bytes = os.path.getsize(engine.output_filename) if os.path.exists(engine.output_filename) else 0
+    frames = engine.frame_scheduler.stats() if engine.frame_scheduler else {}
+    return {
+        "size": f"{width}x{height}",
+        "format": video_format,
+        "used_format": used_format,
+        "backend": spec["backend"],
+        "codec": spec.get("codec") or spec["fourcc"],
+        "target_fps": fps,
+        "achieved_fps": frames.get("achieved_fps", 0.0),
+        "frames": frames,
+        "queue_dropped": engine.queue_dropped(),
+        "stages": engine.stats.summary(),
+        "cpu_seconds": round(cpu_used, 3),
+        "cpu_percent": round(cpu_used / elapsed * 100, 1) if elapsed else 0.0,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "output_bytes_per_second": round(output_bytes / elapsed) if elapsed else 0,
+        "error": engine.error,
+    }
+
+
+# Из settings.json замер берет только настройки кодирования и конвейера: режимы записи
+# (таймлапс, VFR, спул, звук, курсор, адаптация, ротация, монитор) меняли бы то, что измеряется
+BENCH_SETTINGS = ("queue_depth", "queue_policy", "ffmpeg_path", "ffmpeg_preset", "ffmpeg_crf", "ffmpeg_threads",
+                  "encode_workers", "segment_seconds", "change_detection", "change_tile_size",
+                  "output_scale", "output_width", "output_height", "scale_interpolation", "fragmented_mp4")
+
+
+def cli_bench(args):
+    import platform
+
+    saved = load_engine_options()
+    options = dict(ENGINE_DEFAULTS, **{key: saved[key] for key in BENCH_SETTINGS})
+    if args.workers is not None:
+        options["encode_workers"] = args.workers
+    if args.scale is not None:
+        options["output_scale"] = args.scale
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    formats = args.formats.split(",")
+    fps_values = [int(fps) for fps in args.fps.split(",")]
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpu_count": os.cpu_count(), "opencv": cv2.__version__, "numpy": np.__version__},
+        "duration": args.duration,
+        "change_rate": args.change_rate,
+        "options": options,
+        "results": [],
+    }
+    # peak_rss_bytes растет монотонно за весь процесс, поэтому случаи идут от меньших к большим
+    with tempfile.TemporaryDirectory(prefix="bandicam_bench_") as folder:
+        for width, height in sorted(sizes, key=lambda size: size[0] * size[1]):
+            for video_format in formats:
+                for fps in fps_values:
+                    print(f"Замер: {width}x{height} {video_format} {fps} FPS")
+                    result = bench_case(width, height, video_format, fps, args.duration, args.change_rate, options, folder)
+                    report["results"].append(result)
+
+    text = json.dumps(report, indent=4, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Результаты сохранены в: {os.path.abspath(args.out)}")
+    else:
+        print(text)
+    return 1 if any(result["error"] for result in report["results"]) else 0
+
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog="bandicam.py", description="Запись экрана без окна")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="записать область экрана")
+    record.add_argument("--region", type=parse_region, action="append", help="x,y,w,h; можно повторять - каждая область в свой файл")
+    record.add_argument("--monitor", type=parse_monitor, action="append",
+                        help="номер монитора (0 - все одной картинкой) или each - каждый в свой файл; можно повторять")
+    record.add_argument("--fps", type=int, default=30)
+    record.add_argument("--duration", type=float, help="длительность в секундах; без нее запись идет до Ctrl+C")
+    record.add_argument("--out", help="файл (формат по расширению) или папка для записи")
+    record.add_argument("--format", choices=list(VIDEO_FORMATS))
+    record.add_argument("--workers", type=int, help="число процессов кодирования (encode_workers)")
+    record.add_argument("--scale", type=float, help="масштаб выходного видео (output_scale), например 0.5")
+    record.add_argument("--source", default="screen", help="screen, synthetic или путь к видеофайлу для воспроизведения")
+    record.add_argument("--change-rate", type=float, default=1.0, help="доля меняющихся кадров для source=synthetic")
+    record.add_argument("--timelapse", type=float, metavar="SECONDS", help="таймлапс: кадр раз в SECONDS секунд, воспроизведение с --fps")
+    record.add_argument("--vfr", action="store_true", help="переменная частота кадров: в файл только изменившиеся кадры")
+    record.add_argument("--spool", action="store_true", help="писать кадры в спул и кодировать после остановки (spool)")
+    record.add_argument("--cursor", action="store_true", help="рисовать курсор и подсветку кликов (draw_cursor)")
+    record.add_argument("--audio", help="звук: microphone, loopback, synthetic или путь к WAV-файлу (audio_source)")
+    record.set_defaults(handler=cli_record)
+
+    transcode = commands.add_parser("transcode", help="перекодировать (или продолжить перекодирование) спулов записи")
+    transcode.add_argument("spools", nargs="+", help="файлы .spool")
+    transcode.set_defaults(handler=cli_transcode)
+
+    bench = commands.add_parser("bench", help="замер производительности конвейера на синтетическом источнике")
+    bench.add_argument("--sizes", default="742x340,1920x1080,2560x1440,3840x2160", help="размеры через запятую, WxH")
+    bench.add_argument("--formats", default=".wmv,.mp4", help="форматы через запятую, см. record --format")
+    bench.add_argument("--fps", default="30,60", help="целевые FPS через запятую")
+    bench.add_argument("--duration", type=float, default=5.0, help="длительность каждого замера в секундах")
+    bench.add_argument("--change-rate", type=float, default=1.0, help="доля меняющихся кадров")
+    bench.add_argument("--workers", type=int, help="число процессов кодирования (encode_workers)")
+    bench.add_argument("--scale", type=float, help="масштаб выходного видео (output_scale)")
+    bench.add_argument("--out", help="файл JSON для результатов; без него вывод в консоль")
+    bench.set_defaults(handler=cli_bench)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
 
-    def take_screenshot(self):
-        try:
-            with mss.mss() as sct:
-                if self.is_full_screen_mode.get():
-                    monitor = sct.monitors[1]
-                else:
-                    monitor = {"top": self.record_y, "left": self.record_x,
-                               "width": self.record_width, "height": self.record_height}
-                
-                sct_img = sct.grab(monitor)
-                img = np.array(sct_img)
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-                
-                if not os.path.exists(self.output_folder):
-                    os.makedirs(self.output_folder, exist_ok=True)
-                
-                now = datetime.now()
-                timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-                
-                screenshot_filename = os.path.join(self.output_folder, f"screenshot_{timestamp}.jpg")
-                
-                is_success, buffer = cv2.imencode(".jpg", img_rgb)
-                if is_success:
-                    with open(screenshot_filename, "wb") as f:
-                        f.write(buffer)
-                else:
-                    raise Exception("Не удалось закодировать изображение для сохранения.")
-                
-                self.screenshot_button.config(text="✅") 
-                self.master.after(1000, lambda: self.screenshot_button.config(text="📷")) 
 
-                print(f"Скриншот сохранен в: {os.path.abspath(screenshot_filename)}")
+if __name__ == "__main__":
+    # Нужно для процессов пула кодирования в собранном PyInstaller exe
+    multiprocessing.freeze_support()
 
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сделать скриншот: {e}")
-            print(f"Ошибка скриншота: {e}")
+    # С аргументами командной строки работаем без окна
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
 
-if __name__ == "__main__":
     root = tk.Tk()
     app = ScreenRecorder(root)
     root.mainloop()